@@ -0,0 +1,64 @@
+-- Adds the task counts per challenge and status read by the challenge summary
+-- endpoint, and the triggers on the tasks table that keep them up to date.
+-- Needs PostgreSQL 10 or later. The counts can be recounted at any time
+-- with manage.py repair_status_counts.
+-- Run against existing databases; new databases get this through create_db.
+BEGIN;
+CREATE TABLE IF NOT EXISTS challenge_status_counts (
+    challenge_slug varchar NOT NULL,
+    status varchar NOT NULL,
+    count integer NOT NULL,
+    PRIMARY KEY (challenge_slug, status)
+);
+LOCK TABLE tasks IN SHARE MODE;
+CREATE OR REPLACE FUNCTION count_task_statuses() RETURNS trigger AS $$
+BEGIN
+    IF TG_OP = 'INSERT' THEN
+        INSERT INTO challenge_status_counts (challenge_slug, status, count)
+        SELECT challenge_slug, COALESCE(status, ''), count(*)
+        FROM new_tasks
+        GROUP BY 1, 2 ORDER BY 1, 2
+        ON CONFLICT (challenge_slug, status) DO UPDATE
+        SET count = challenge_status_counts.count + EXCLUDED.count;
+    ELSIF TG_OP = 'UPDATE' THEN
+        INSERT INTO challenge_status_counts (challenge_slug, status, count)
+        SELECT challenge_slug, status, sum(n) FROM (
+            SELECT challenge_slug, COALESCE(status, '') AS status, -1 AS n
+            FROM old_tasks
+            UNION ALL
+            SELECT challenge_slug, COALESCE(status, ''), 1
+            FROM new_tasks) deltas
+        GROUP BY 1, 2 HAVING sum(n) != 0 ORDER BY 1, 2
+        ON CONFLICT (challenge_slug, status) DO UPDATE
+        SET count = challenge_status_counts.count + EXCLUDED.count;
+        DELETE FROM challenge_status_counts WHERE count <= 0
+            AND challenge_slug IN (SELECT challenge_slug FROM old_tasks);
+    ELSE
+        INSERT INTO challenge_status_counts (challenge_slug, status, count)
+        SELECT challenge_slug, COALESCE(status, ''), -count(*)
+        FROM old_tasks
+        GROUP BY 1, 2 ORDER BY 1, 2
+        ON CONFLICT (challenge_slug, status) DO UPDATE
+        SET count = challenge_status_counts.count + EXCLUDED.count;
+        DELETE FROM challenge_status_counts WHERE count <= 0
+            AND challenge_slug IN (SELECT challenge_slug FROM old_tasks);
+    END IF;
+    RETURN NULL;
+END;
+$$ LANGUAGE plpgsql;
+DROP TRIGGER IF EXISTS tasks_status_counts_insert ON tasks;
+CREATE TRIGGER tasks_status_counts_insert AFTER INSERT ON tasks
+    REFERENCING NEW TABLE AS new_tasks
+    FOR EACH STATEMENT EXECUTE PROCEDURE count_task_statuses();
+DROP TRIGGER IF EXISTS tasks_status_counts_update ON tasks;
+CREATE TRIGGER tasks_status_counts_update AFTER UPDATE ON tasks
+    REFERENCING OLD TABLE AS old_tasks NEW TABLE AS new_tasks
+    FOR EACH STATEMENT EXECUTE PROCEDURE count_task_statuses();
+DROP TRIGGER IF EXISTS tasks_status_counts_delete ON tasks;
+CREATE TRIGGER tasks_status_counts_delete AFTER DELETE ON tasks
+    REFERENCING OLD TABLE AS old_tasks
+    FOR EACH STATEMENT EXECUTE PROCEDURE count_task_statuses();
+DELETE FROM challenge_status_counts;
+INSERT INTO challenge_status_counts (challenge_slug, status, count)
+SELECT challenge_slug, COALESCE(status, ''), count(*) FROM tasks GROUP BY 1, 2;
+COMMIT;
@@ -0,0 +1,76 @@
+-- Adds the task counts per challenge, grid tile and status used to estimate
+-- the challenge summary within a user's editing area, and updates the
+-- triggers on the tasks table to keep them up to date as well.
+-- Needs bin/add-challenge-status-counts.sql to have been run first.
+-- Run against existing databases; new databases get this through create_db.
+BEGIN;
+CREATE TABLE IF NOT EXISTS challenge_tile_counts (
+    challenge_slug varchar NOT NULL,
+    tile_x integer NOT NULL,
+    tile_y integer NOT NULL,
+    status varchar NOT NULL,
+    count integer NOT NULL,
+    PRIMARY KEY (challenge_slug, tile_x, tile_y, status)
+);
+LOCK TABLE tasks IN SHARE MODE;
+CREATE OR REPLACE FUNCTION count_task_statuses() RETURNS trigger AS $$
+DECLARE
+    deltas text;
+BEGIN
+    -- the change in counts, per task
+    IF TG_OP = 'INSERT' THEN
+        deltas := 'SELECT *, 1 AS n FROM new_tasks';
+    ELSIF TG_OP = 'UPDATE' THEN
+        deltas := 'SELECT *, -1 AS n FROM old_tasks
+                   UNION ALL SELECT *, 1 FROM new_tasks';
+    ELSE
+        deltas := 'SELECT *, -1 AS n FROM old_tasks';
+    END IF;
+    deltas := 'WITH deltas AS (
+        SELECT challenge_slug, COALESCE(status, '''') AS status,
+            floor(ST_X(location) / 0.1)::integer AS tile_x,
+            floor(ST_Y(location) / 0.1)::integer AS tile_y,
+            n
+        FROM (' || deltas || ') t) ';
+    EXECUTE deltas || ', statuses AS (
+        INSERT INTO challenge_status_counts (challenge_slug, status, count)
+        SELECT challenge_slug, status, sum(n) FROM deltas
+        GROUP BY 1, 2 HAVING sum(n) != 0 ORDER BY 1, 2
+        ON CONFLICT (challenge_slug, status) DO UPDATE
+        SET count = challenge_status_counts.count + EXCLUDED.count)
+    INSERT INTO challenge_tile_counts
+        (challenge_slug, tile_x, tile_y, status, count)
+    SELECT challenge_slug, tile_x, tile_y, status, sum(n) FROM deltas
+    WHERE tile_x IS NOT NULL
+    GROUP BY 1, 2, 3, 4 HAVING sum(n) != 0 ORDER BY 1, 2, 3, 4
+    ON CONFLICT (challenge_slug, tile_x, tile_y, status) DO UPDATE
+    SET count = challenge_tile_counts.count + EXCLUDED.count';
+    -- drop the counts that went down to zero
+    EXECUTE deltas || ', statuses AS (
+        DELETE FROM challenge_status_counts c USING deltas d
+        WHERE c.challenge_slug = d.challenge_slug AND c.status = d.status
+            AND c.count <= 0)
+    DELETE FROM challenge_tile_counts c USING deltas d
+    WHERE c.challenge_slug = d.challenge_slug
+        AND c.tile_x = d.tile_x AND c.tile_y = d.tile_y
+        AND c.status = d.status AND c.count <= 0';
+    RETURN NULL;
+END;
+$$ LANGUAGE plpgsql;
+DROP TRIGGER IF EXISTS tasks_status_counts_insert ON tasks;
+CREATE TRIGGER tasks_status_counts_insert AFTER INSERT ON tasks
+    REFERENCING NEW TABLE AS new_tasks
+    FOR EACH STATEMENT EXECUTE PROCEDURE count_task_statuses();
+DROP TRIGGER IF EXISTS tasks_status_counts_update ON tasks;
+CREATE TRIGGER tasks_status_counts_update AFTER UPDATE ON tasks
+    REFERENCING OLD TABLE AS old_tasks NEW TABLE AS new_tasks
+    FOR EACH STATEMENT EXECUTE PROCEDURE count_task_statuses();
+DROP TRIGGER IF EXISTS tasks_status_counts_delete ON tasks;
+CREATE TRIGGER tasks_status_counts_delete AFTER DELETE ON tasks
+    REFERENCING OLD TABLE AS old_tasks
+    FOR EACH STATEMENT EXECUTE PROCEDURE count_task_statuses();
+DELETE FROM challenge_tile_counts;
+INSERT INTO challenge_tile_counts (challenge_slug, tile_x, tile_y, status, count)
+SELECT challenge_slug, floor(ST_X(location) / 0.1)::integer, floor(ST_Y(location) / 0.1)::integer, COALESCE(status, ''), count(*)
+FROM tasks WHERE location IS NOT NULL GROUP BY 1, 2, 3, 4;
+COMMIT;
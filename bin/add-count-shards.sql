@@ -0,0 +1,64 @@
+-- Spreads the task counts per challenge and status, and per grid tile and
+-- status, over several rows each, so that concurrent status changes in a
+-- challenge don't all wait on the same row, and updates the triggers on
+-- the tasks table to add to the shard of their session.
+-- Needs bin/add-challenge-tile-counts.sql to have been run first.
+-- Run against existing databases; new databases get this through create_db.
+BEGIN;
+LOCK TABLE tasks IN SHARE MODE;
+ALTER TABLE challenge_status_counts
+    ADD COLUMN shard smallint NOT NULL DEFAULT 0,
+    DROP CONSTRAINT challenge_status_counts_pkey,
+    ADD PRIMARY KEY (challenge_slug, status, shard);
+ALTER TABLE challenge_tile_counts
+    ADD COLUMN shard smallint NOT NULL DEFAULT 0,
+    DROP CONSTRAINT challenge_tile_counts_pkey,
+    ADD PRIMARY KEY (challenge_slug, tile_x, tile_y, status, shard);
+CREATE OR REPLACE FUNCTION count_task_statuses() RETURNS trigger AS $$
+DECLARE
+    deltas text;
+BEGIN
+    -- the change in counts, per task
+    IF TG_OP = 'INSERT' THEN
+        deltas := 'SELECT *, 1 AS n FROM new_tasks';
+    ELSIF TG_OP = 'UPDATE' THEN
+        deltas := 'SELECT *, -1 AS n FROM old_tasks
+                   UNION ALL SELECT *, 1 FROM new_tasks';
+    ELSE
+        deltas := 'SELECT *, -1 AS n FROM old_tasks';
+    END IF;
+    deltas := 'WITH deltas AS (
+        SELECT challenge_slug, COALESCE(status, '''') AS status,
+            floor(ST_X(location) / 0.1)::integer AS tile_x,
+            floor(ST_Y(location) / 0.1)::integer AS tile_y,
+            pg_backend_pid() % 16 AS shard, n
+        FROM (' || deltas || ') t) ';
+    EXECUTE deltas || ', statuses AS (
+        INSERT INTO challenge_status_counts
+            (challenge_slug, status, shard, count)
+        SELECT challenge_slug, status, shard, sum(n) FROM deltas
+        GROUP BY 1, 2, 3 HAVING sum(n) != 0 ORDER BY 1, 2, 3
+        ON CONFLICT (challenge_slug, status, shard) DO UPDATE
+        SET count = challenge_status_counts.count + EXCLUDED.count)
+    INSERT INTO challenge_tile_counts
+        (challenge_slug, tile_x, tile_y, status, shard, count)
+    SELECT challenge_slug, tile_x, tile_y, status, shard, sum(n) FROM deltas
+    WHERE tile_x IS NOT NULL
+    GROUP BY 1, 2, 3, 4, 5 HAVING sum(n) != 0 ORDER BY 1, 2, 3, 4, 5
+    ON CONFLICT (challenge_slug, tile_x, tile_y, status, shard) DO UPDATE
+    SET count = challenge_tile_counts.count + EXCLUDED.count';
+    -- drop this shard's counts that went down to zero. A shard can go
+    -- below zero when a task is counted in another one; only the sum
+    -- over the shards is the number of tasks.
+    EXECUTE deltas || ', statuses AS (
+        DELETE FROM challenge_status_counts c USING deltas d
+        WHERE c.challenge_slug = d.challenge_slug AND c.status = d.status
+            AND c.shard = d.shard AND c.count = 0)
+    DELETE FROM challenge_tile_counts c USING deltas d
+    WHERE c.challenge_slug = d.challenge_slug
+        AND c.tile_x = d.tile_x AND c.tile_y = d.tile_y
+        AND c.status = d.status AND c.shard = d.shard AND c.count = 0';
+    RETURN NULL;
+END;
+$$ LANGUAGE plpgsql;
+COMMIT;
@@ -0,0 +1,20 @@
+-- Adds the table for bulk task import jobs run by the import worker
+-- (manage.py run_import_jobs).
+-- Run against existing databases; new databases get this through create_db.
+CREATE TABLE IF NOT EXISTS import_jobs (
+    id serial PRIMARY KEY,
+    challenge_slug varchar NOT NULL REFERENCES challenges (slug) ON UPDATE CASCADE ON DELETE CASCADE,
+    kind varchar NOT NULL,
+    status varchar NOT NULL,
+    host varchar NOT NULL,
+    filename varchar NOT NULL,
+    size bigint,
+    bytes_read bigint,
+    rows integer,
+    created timestamp without time zone NOT NULL,
+    started timestamp without time zone,
+    finished timestamp without time zone,
+    result varchar,
+    error varchar
+);
+CREATE INDEX IF NOT EXISTS idx_import_job_host_status ON import_jobs (host, status);
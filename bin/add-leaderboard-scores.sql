@@ -0,0 +1,13 @@
+-- Adds the table of leaderboard scores. Fill it by rebuilding the metrics
+-- once after adding it, with manage.py update_metrics --rebuild.
+-- Run against existing databases; new databases get this through create_db.
+CREATE TABLE IF NOT EXISTS leaderboard_scores (
+    period varchar NOT NULL,
+    period_start timestamp without time zone NOT NULL,
+    challenge_slug varchar NOT NULL,
+    user_id integer NOT NULL,
+    user_name varchar,
+    score integer NOT NULL,
+    PRIMARY KEY (period, period_start, challenge_slug, user_id)
+);
+CREATE INDEX IF NOT EXISTS idx_leaderboard_scores_rank ON leaderboard_scores (period, period_start, challenge_slug, score DESC, user_id);
@@ -0,0 +1,8 @@
+-- Replaces the single column indexes on metrics_historical.user_id and
+-- challenge_slug with indexes on those columns and the timestamp, so that the
+-- history for a user or a challenge over a time window is an index range scan.
+-- Run against existing databases; new databases get this through create_db.
+CREATE INDEX CONCURRENTLY IF NOT EXISTS idx_metrics_userid_timestamp ON metrics_historical (user_id, timestamp);
+CREATE INDEX CONCURRENTLY IF NOT EXISTS idx_metrics_challengeslug_timestamp ON metrics_historical (challenge_slug, timestamp);
+DROP INDEX CONCURRENTLY IF EXISTS idx_metrics_userid;
+DROP INDEX CONCURRENTLY IF EXISTS idx_metrics_challengeslug;
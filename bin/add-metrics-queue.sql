@@ -0,0 +1,20 @@
+-- Adds the queue of actions that have not been counted in the metrics yet,
+-- and the trigger on the actions table that fills it. Needs PostgreSQL 10
+-- or later. Rebuild the metrics once after adding it, with
+-- manage.py update_metrics --rebuild, which counts all actions.
+-- Run against existing databases; new databases get this through create_db.
+BEGIN;
+CREATE TABLE IF NOT EXISTS metrics_queue (
+    action_id integer PRIMARY KEY
+);
+CREATE OR REPLACE FUNCTION queue_actions() RETURNS trigger AS $$
+BEGIN
+    INSERT INTO metrics_queue (action_id) SELECT id FROM new_actions;
+    RETURN NULL;
+END;
+$$ LANGUAGE plpgsql;
+DROP TRIGGER IF EXISTS actions_metrics_queue ON actions;
+CREATE TRIGGER actions_metrics_queue AFTER INSERT ON actions
+    REFERENCING NEW TABLE AS new_actions
+    FOR EACH STATEMENT EXECUTE PROCEDURE queue_actions();
+COMMIT;
@@ -0,0 +1,16 @@
+-- Adds the table of hourly, weekly and monthly metrics for the history
+-- charts. Fill it by rebuilding the metrics once after adding it, with
+-- manage.py update_metrics --rebuild.
+-- Run against existing databases; new databases get this through create_db.
+CREATE TABLE IF NOT EXISTS metrics_rollups (
+    resolution varchar NOT NULL,
+    timestamp timestamp without time zone NOT NULL,
+    user_id integer NOT NULL,
+    user_name varchar,
+    challenge_slug varchar NOT NULL,
+    status varchar NOT NULL,
+    count integer,
+    PRIMARY KEY (resolution, timestamp, user_id, challenge_slug, status)
+);
+CREATE INDEX IF NOT EXISTS idx_metrics_rollups_userid_timestamp ON metrics_rollups (resolution, user_id, timestamp);
+CREATE INDEX IF NOT EXISTS idx_metrics_rollups_challengeslug_timestamp ON metrics_rollups (resolution, challenge_slug, timestamp);
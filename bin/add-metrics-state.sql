@@ -0,0 +1,9 @@
+-- Adds the table that records how far the metrics tables have been updated
+-- (manage.py update_metrics). Rebuild the metrics once after adding it, with
+-- manage.py update_metrics --rebuild.
+-- Run against existing databases; new databases get this through create_db.
+CREATE TABLE IF NOT EXISTS metrics_state (
+    name varchar PRIMARY KEY,
+    last_action_id integer NOT NULL,
+    updated timestamp without time zone
+);
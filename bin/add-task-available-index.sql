@@ -0,0 +1,6 @@
+-- Adds the partial index used for handing out available tasks, and drops
+-- the index on tasks.id that duplicates the unique constraint on that column.
+-- Run against existing databases; new databases get this through create_db.
+CREATE INDEX CONCURRENTLY IF NOT EXISTS idx_task_available ON tasks (challenge_slug, random) WHERE status IN ('available', 'skipped', 'created');
+DROP INDEX CONCURRENTLY IF EXISTS idx_id;
+ANALYZE tasks;
@@ -0,0 +1,5 @@
+-- Adds the task content hash used by the challenge task sync endpoint
+-- (/api/admin/challenge/<slug>/tasks/sync). Existing tasks start without
+-- a hash, so they are written once on their first sync.
+-- Run against existing databases; new databases get this through create_db.
+ALTER TABLE tasks ADD COLUMN IF NOT EXISTS content_hash varchar(32);
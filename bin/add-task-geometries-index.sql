@@ -0,0 +1,5 @@
+-- Adds the index on task_geometries.task_id, used for getting the geometries
+-- of tasks and for computing task locations by task id range
+-- (manage.py populate_task_location).
+-- Run against existing databases; new databases get this through create_db.
+CREATE INDEX CONCURRENTLY IF NOT EXISTS idx_task_geometries_taskid ON task_geometries (task_id);
@@ -0,0 +1,7 @@
+-- Adds the task lease column used by the stale task reaper
+-- (manage.py clean_stale_tasks). Tasks that are currently assigned or being
+-- edited get a lease of one hour from their latest action.
+-- Run against existing databases; new databases get this through create_db.
+ALTER TABLE tasks ADD COLUMN IF NOT EXISTS assigned_until timestamp without time zone;
+UPDATE tasks SET assigned_until = latest.timestamp + interval '1 hour' FROM (SELECT task_id, max(timestamp) AS timestamp FROM actions GROUP BY task_id) latest WHERE tasks.id = latest.task_id AND tasks.status IN ('assigned', 'editing');
+CREATE INDEX IF NOT EXISTS idx_task_assigned_until ON tasks (assigned_until) WHERE assigned_until IS NOT NULL;
@@ -0,0 +1,46 @@
+#!/usr/bin/env python
+
+"""Times the grouping and date padding of statistics query results
+(maproulette.helpers.as_stats_dict) for growing numbers of rows and days,
+to check that the time per row stays flat as the input grows.
+
+usage: benchmark-stats.py [max rows]"""
+
+import sys
+import time
+import random
+from datetime import datetime, timedelta
+from maproulette.helpers import as_stats_dict
+
+max_rows = int(sys.argv[1]) if len(sys.argv) > 1 else 512000
+statuses = ['available', 'skipped', 'fixed', 'deleted', 'alreadyfixed',
+            'falsepositive', 'assigned', 'editing']
+
+
+def rows(count, days, groups):
+    """Return count (group, day, count) rows spread over days days"""
+    rng = random.Random(count)
+    start = datetime(2014, 1, 1)
+    return [('group%i' % rng.randrange(groups),
+             start + timedelta(rng.randrange(days)),
+             rng.randrange(100)) for n in range(count)]
+
+
+def timed(tuples):
+    start = time.time()
+    as_stats_dict(tuples)
+    return time.time() - start
+
+
+print('%10s %8s %8s %10s %12s' % (
+    'rows', 'days', 'groups', 'seconds', 'us per row'))
+count = 1000
+while count <= max_rows:
+    # a year of days for a growing number of groups (users, challenges),
+    # and a growing number of days for the statuses
+    for days, groups in ((365, max(1, count // 365)),
+                         (max(1, count // len(statuses)), len(statuses))):
+        seconds = timed(rows(count, days, groups))
+        print('%10i %8i %8i %10.3f %12.2f' % (
+            count, days, groups, seconds, seconds / count * 1000000))
+    count *= 4
@@ -1,57 +1,44 @@
 #!/usr/bin/env python
 
-import json
+"""Updates the tasks of a challenge to match a JSON file with the full list
+of tasks the challenge should have, in the admin API bulk task format.
+
+The comparison happens on the server: new tasks are created, changed tasks
+updated, and tasks that are no longer in the file are marked as deleted.
+Tasks that were marked as false positives are left alone. The server runs
+the sync as an import job; this waits for it to finish.
+
+usage: challenge-update.py challenge_slug tasks.json [server]"""
+
 import sys
+import time
 import requests
 
 challenge_id = sys.argv[1]
-old_fname = sys.argv[2]
-cur_fname = sys.argv[3]
-
-r = requests.get('http://localhost:8866/api/admin/challenge/%s/tasks' % challenge_id)
+cur_fname = sys.argv[2]
+server = sys.argv[3] if len(sys.argv) > 3 else 'http://localhost:8866'
+
+with open(cur_fname, 'rb') as f:
+    r = requests.put('%s/api/admin/challenge/%s/tasks/sync' %
+                     (server, challenge_id),
+                     headers={'Content-type': 'application/json'},
+                     data=f)
 r.raise_for_status()
 
-statuses_raw = r.json()
-statuses = {i['id']: i['status'] for i in statuses_raw}
-
-old = {i['id']: i for i in json.loads(open(old_fname, 'r').read())}
-new = {i['id']: i for i in json.loads(open(new_fname, 'r').read())}
-
-# First, we'll remove any false positives from either the new or old list
-old_ids = Set([i for i in old if statuses.get(i) != 'false_positive'])
-new_ids = Set([i for i in cur if statuses.get(i) != 'false_positive'] and i not in old)
-
-# Now figure out what's old, what's new and what's changed
-deleted_ids = cur_ids.difference(new_ids)
-new_ids = new_ids.difference(cur_ids)
-changed_ids = [i for in in old_ids.intersection(new_ids) if old[i] != new[i]]
-
-# Output stats here, and optional "do not do"
-
-# In order of priority, delete old task, update tasks and add tasks
-for i in deleted_ids:
-    print("Deleting %s... ", % i)
-    requests.delete('http://localhost:8866/api/admin/challenge/%s/task/%s' %
-                    challenge_id, i)
-    r.raise_for_status()
-    print("Done")
-
-for i in changed_ids:
-    print("Uploading changed %s...", % i)
-    requests.put('http://localhost:8886/api/admin/challenge/%s/task/%s' %
-                 challenge_id, i,
-                 headers = {'Content-type': 'application/json',
-                            'Accept': 'text/plain'},
-                 payload = json.dump(new[i]))
-    r.raise_for_status()
-    print("Done")
-
-for i in to_new_ids:
-    print("Uploading new %s...", % i)
-    requests.put('http://localhost:8866/api/admin/challenge/%s/task/%s' %
-                 challenge_id, i, payload = json.dumps(new[i]),
-                 headers = {'Content-type': 'application/json',
-                            'Accept': 'text/plain'},
-                 payload = json.dumps(new[i]))
+job_url = '%s%s' % (server, r.json()['url'])
+while True:
+    r = requests.get(job_url)
     r.raise_for_status()
-    print("Done")
+    job = r.json()
+    if job['status'] not in ('queued', 'running'):
+        break
+    time.sleep(5)
+if job['status'] != 'done':
+    sys.exit("Sync failed: %s" % job['error'])
+
+summary = job['result']
+print("Done. %i tasks created, %i updated, %i deleted, %i unchanged" % (
+    summary['created'],
+    summary['updated'],
+    summary['deleted'],
+    summary['unchanged']))
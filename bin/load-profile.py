@@ -0,0 +1,77 @@
+#!/usr/bin/env python
+
+"""Puts a MapRoulette instance under a mapper-like load, and reports the
+throughput and response times per kind of request. Meant to be run against
+a local instance filled with manage.py create_testdata.
+
+Each thread plays a mapper: it gets a random task from a challenge, sets
+its status, and now and then looks at the challenge summary or the stats.
+
+usage: load-profile.py [server] [threads] [seconds] [challenges]"""
+
+import sys
+import time
+import random
+import threading
+import requests
+
+server = sys.argv[1] if len(sys.argv) > 1 else 'http://localhost:8866'
+threads = int(sys.argv[2]) if len(sys.argv) > 2 else 8
+seconds = int(sys.argv[3]) if len(sys.argv) > 3 else 60
+challenges = int(sys.argv[4]) if len(sys.argv) > 4 else 10
+
+# the final task statuses a mapper sets, and how often
+statuses = ['fixed'] * 5 + ['skipped'] * 3 + ['falsepositive', 'alreadyfixed']
+
+timings = {}
+lock = threading.Lock()
+
+
+def timed(name, method, path, **kwargs):
+    start = time.time()
+    r = requests.request(method, server + path, **kwargs)
+    elapsed = time.time() - start
+    with lock:
+        timings.setdefault(name, []).append((elapsed, r.status_code))
+    return r
+
+
+def mapper(seed, deadline):
+    rng = random.Random(seed)
+    while time.time() < deadline:
+        slug = 'test%i' % rng.randint(1, challenges)
+        r = timed('get task', 'GET',
+                  '/api/challenge/%s/task?assign=1' % slug)
+        if r.status_code == 200:
+            identifier = r.json()['identifier']
+            timed('set status', 'PUT',
+                  '/api/challenge/%s/task/%s' % (slug, identifier),
+                  data={'action': rng.choice(statuses), 'editor': 'id'})
+        if rng.random() < 0.3:
+            timed('summary', 'GET', '/api/challenge/%s/summary' % slug)
+        if rng.random() < 0.05:
+            timed('stats', 'GET', '/api/stats/challenge/%s' % slug)
+
+
+def percentile(values, p):
+    return values[min(len(values) - 1, int(len(values) * p))]
+
+
+deadline = time.time() + seconds
+workers = [threading.Thread(target=mapper, args=(n, deadline))
+           for n in range(threads)]
+for worker in workers:
+    worker.start()
+for worker in workers:
+    worker.join()
+
+print('%-12s %8s %8s %8s %8s %8s %8s' % (
+    'request', 'count', 'errors', 'per sec', 'p50 ms', 'p95 ms', 'p99 ms'))
+for name, results in sorted(timings.items()):
+    elapsed = sorted(e for e, status in results)
+    errors = len([s for e, s in results if s >= 500])
+    print('%-12s %8i %8i %8.1f %8.1f %8.1f %8.1f' % (
+        name, len(results), errors, len(results) / float(seconds),
+        percentile(elapsed, 0.5) * 1000,
+        percentile(elapsed, 0.95) * 1000,
+        percentile(elapsed, 0.99) * 1000))
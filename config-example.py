@@ -19,7 +19,8 @@ OSM = {
 DEBUG = (len(sys.argv)>1 and sys.argv[1] == 'runserver')
 
 # This is the buffer for looking for tasks / challenges near the given
-# lon/lat
+# lon/lat. It is also the max distance (in degrees) for getting the
+# nearest task to a lon/lat.
 NEARBUFFER = 0.01
 
 # this is the threshold in square degrees
@@ -46,8 +47,78 @@ MAILGUN_API_KEY = 'CHANGE THIS'
 # URL to the metrics site instance, for allowing CORS requests from there
 METRICS_URL = 'http://metrics.maproulette.org/'
 
-# Max number of tasks in a bulk task update
-MAX_TASKS_BULK_UPDATE = 5000
+# Number of task ids each worker buffers per challenge for handing out
+# random tasks, and the level at which the buffer is topped up again
+TASK_DISPENSER_SIZE = 500
+TASK_DISPENSER_LOW_WATER = 50
+
+# Max number of upcoming tasks a client can get in one request
+MAX_TASKS_NEXT = 10
+
+# Queue task actions and insert them in bulk every ACTION_BUFFER_INTERVAL
+# seconds (or once ACTION_BUFFER_MAX_SIZE are waiting) instead of writing
+# each action in its own request. Task statuses are still set right away.
+# With uwsgi, this needs enable-threads.
+BUFFER_ACTIONS = False
+ACTION_BUFFER_INTERVAL = 2
+ACTION_BUFFER_MAX_SIZE = 1000
+
+# Number of seconds a task stays assigned to (or being edited by) a
+# mapper before the stale task reaper makes it available again
+TASK_LEASE_SECONDS = 3600
+
+# Directory where bulk task uploads are spooled until the import worker
+# (manage.py run_import_jobs) has stored them. Uploads are run on the
+# host that received them, so this can be local to each host.
+IMPORT_JOBS_DIR = '/tmp/maproulette-jobs'
+
+# Number of seconds the import worker waits before checking for new jobs
+IMPORT_JOBS_INTERVAL = 5
+
+# Number of tasks stored per transaction when streaming in GeoJSON tasks
+TASKS_CHUNK_SIZE = 1000
+
+# Size in bytes up to which tasks staged for a bulk load (COPY) are kept
+# in memory before they are spooled to disk
+BULK_LOAD_SPOOL_SIZE = 16 * 1024 * 1024
+
+# Number of processes that parse and encode task geometries for a bulk
+# load run by an import job or manage.py load_tasks (None for one per
+# core, 1 to do it in the same process), and the number of tasks handed
+# to a process at a time. The admin API's synchronous bulk load and sync
+# endpoints always do it in the request.
+BULK_LOAD_PROCESSES = None
+BULK_LOAD_CHUNK_SIZE = 100
+
+# The metrics tables are updated with the actions queued since the last
+# update (manage.py update_metrics), committing every METRICS_BATCH_SIZE
+# actions
+METRICS_BATCH_SIZE = 100000
+
+# The hourly metrics for the history charts are kept for the last
+# METRICS_HOURLY_DAYS days. A history chart shows at most
+# STATS_HISTORY_MAX_POINTS points, at the finest resolution (hour, day,
+# week or month) that keeps it within that, unless one is asked for. Asking
+# for hours before the last METRICS_HOURLY_DAYS days is an error.
+METRICS_HOURLY_DAYS = 14
+STATS_HISTORY_MAX_POINTS = 400
+
+# The most users a page of a leaderboard (/api/stats/leaderboard) can have
+LEADERBOARD_MAX_LIMIT = 100
+
+# The action history export (/api/stats/export, manage.py export_actions)
+# fetches and sends EXPORT_CHUNK_SIZE actions at a time. Each worker runs
+# at most EXPORT_MAX_RUNNING exports through the API at once.
+EXPORT_CHUNK_SIZE = 1000
+EXPORT_MAX_RUNNING = 2
+
+# Each worker caches the responses of the /api/stats endpoints for
+# STATS_CACHE_TTL seconds (0 to not cache them), keeping at most
+# STATS_CACHE_SIZE responses. The cache is emptied when the metrics are
+# updated, which is checked every STATS_CACHE_CHECK_INTERVAL seconds.
+STATS_CACHE_TTL = 300
+STATS_CACHE_SIZE = 1000
+STATS_CACHE_CHECK_INTERVAL = 5
 
 # Basic Authentication user / pass
 AUTHORIZED_USER = 'testuser'
@@ -39,7 +39,8 @@ def install_packages():
                 "virtualenvwrapper",
                 "nginx",
                 "uwsgi",
-                "uwsgi-plugin-python"]
+                "uwsgi-plugin-python",
+                "libyajl2"]
     sudo('apt-get -q -y --no-upgrade install %s' %
          ' '.join(packages), shell=False)
 
@@ -61,8 +62,8 @@ def install_bower():
 def create_deploy_directories(instance):
     basedir = "/srv/www/%s" % instance
     sudo("mkdir -p %s" % basedir)
-    sudo("mkdir -p %s/virtualenv %s/htdocs %s/log %s/cron" %
-         (basedir, basedir, basedir, basedir))
+    sudo("mkdir -p %s/virtualenv %s/htdocs %s/log" %
+         (basedir, basedir, basedir))
     sudo("chown -R www-data:www-data %s" % basedir)
 
 
@@ -108,24 +109,14 @@ def flask_manage(instance, command):
         sudo(cmd, user="www-data")
 
 
-def setup_cron(instance):
+def remove_cron(instance):
+    '''Removes the hourly stale task cron job of older deployments, which
+    the clean_stale_tasks daemon in the uwsgi config replaces'''
     dirname = "/srv/www/%s" % instance
-    upload_template("cron", "%s/cron/scrub_stale_tasks.sh" % dirname,
-                    use_sudo=True,
-                    use_jinja=True,
-                    template_dir="fabric_templates",
-                    context={"instance": instance})
-    sudo('chown www-data:www-data %s/cron/scrub_stale_tasks.sh' % dirname)
-    sudo('chmod 0755 %s/cron/scrub_stale_tasks.sh' % dirname, user='www-data')
-    if exists('/var/spool/cron/crontabs/www-data'):
-        # if an existing crontab file exists, start with that
-        sudo('crontab -l >/tmp/crondump', user='www-data')
-    if not contains('/tmp/crondump', 'scrub_stale_tasks.sh'):
-        # check if the job is already in the file
-        sudo('echo "15 * * * * %s/cron/scrub_stale_tasks.sh >>'
-             ' %s/log/scrub_stale_tasks.log" >> /tmp/crondump' %
-             (dirname, dirname), user='www-data')
-        sudo('crontab /tmp/crondump', user='www-data')
+    if exists('/var/spool/cron/crontabs/www-data', use_sudo=True):
+        sudo('(crontab -l | grep -v scrub_stale_tasks.sh || true) '
+             '| crontab -', user='www-data')
+    sudo('rm -rf %s/cron' % dirname)
 
 
 def install_python_dependencies(instance, upgrade=False):
@@ -145,7 +136,8 @@ def setup_uwsgi_file(instance):
                     use_jinja=True,
                     template_dir="fabric_templates",
                     context={"instance": instance})
-    sudo("ln -s %s %s" % (sites_available_file, sites_enabled_file))
+    if not exists(sites_enabled_file):
+        sudo("ln -s %s %s" % (sites_available_file, sites_enabled_file))
 
 
 def setup_nginx_file(instance):
@@ -297,7 +289,6 @@ def create_deployment(instance, is_dev=True, branch=None):
     install_python_dependencies(instance)
     setup_uwsgi_file(instance)
     setup_nginx_file(instance)
-    setup_cron(instance)
     setup_config_file(instance, is_dev)
     flask_manage(instance, command='create_db')
     install_bower_dependencies(instance)
@@ -316,6 +307,9 @@ def update_application(instance):
     # flask_manage(instance, command='db upgrade')
     update_bower_dependencies(instance)
     compile_jsx(instance)
+    # the background jobs run as uwsgi daemons, replacing the cron job
+    setup_uwsgi_file(instance)
+    remove_cron(instance)
     service('uwsgi', 'start')
 
 
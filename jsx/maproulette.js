@@ -451,6 +451,8 @@ var MRManager = (function () {
                 params.push('lat=' + near.lat);
             }
             if (!assign) params.push('assign=0');
+            // get the task geometries in the same response
+            params.push('include=geometries');
             // if ([1, 2, 3].indexOf(difficulty) > -1 && isChallenge) { // difficulty must be 1,2,3
             //     urlParams += 'difficulty=' + difficulty
             // }
@@ -629,20 +631,14 @@ var MRManager = (function () {
                             toastr.warning('This task is already fixed, or it was marked as not an error.');
                         }, 2000);
                     }
-                    //...and its geometries
-                    $.ajax({
-                        url: '/api/challenge/' + challenge.slug + '/task/' + task.identifier + '/geometries',
-                        async: false,
-                        success: function (data) {
-                            task.features = data.features;
-                            if (!task.hasOwnProperty('instruction') || task.instruction == null || task.instruction === '') {
-                                task.instruction = challenge.instruction;
-                            }
-                            drawTask();
-                            getChallengeStats();
-                            updateHash();
-                        }
-                    });
+                    //...and its geometries, which came with the task
+                    task.features = data.geometries.features;
+                    if (!task.hasOwnProperty('instruction') || task.instruction == null || task.instruction === '') {
+                        task.instruction = challenge.instruction;
+                    }
+                    drawTask();
+                    getChallengeStats();
+                    updateHash();
                 }
             });
         };
@@ -36,154 +36,207 @@ def create_db():
 
 
 @manager.command
-def create_testdata(challenges=10, tasks=100, users=10):
-    """Creates test data in the database"""
-    import uuid
-    import random
-    from maproulette import db
-    from maproulette.models import User, Challenge, Task, TaskGeometry, Action
-    from shapely.geometry import Point, LineString, box
-
-    # statuses to use
-    statuses = ['available',
-                'skipped',
-                'fixed',
-                'deleted',
-                'alreadyfixed',
-                'falsepositive']
-
-    # challenge default strings
-    challenge_help_test = "Sample challenge *help* text"
-    challenge_instruction_test = "Challenge instruction text"
-    task_instruction_text = "Task instruction text"
-
-    # delete old tasks and challenges
-    db.session.query(TaskGeometry).delete()
-    db.session.query(Action).delete()
-    db.session.query(Task).delete()
-    db.session.query(Challenge).delete()
-    db.session.query(User).delete()
-    db.session.commit()
-
-    # create users
-    for uid in range(int(users)):
-        user = User()
-        user.id = uid
-        user.display_name = 'Test User {uid}'.format(uid=uid)
-        db.session.add(user)
-    db.session.commit()
-
-    # create ten challenges
-    for i in range(1, int(challenges) + 1):
-        print("Generating Test Challenge #%d" % i)
-        minx = -120
-        maxx = -40
-        miny = 20
-        maxy = 50
-        challengepoly = None
-        slug = "test%d" % i
-        title = "Test Challenge %d" % i
-        challenge = Challenge(slug, title)
-        challenge.difficulty = random.choice([1, 2, 3])
-        challenge.active = True
-        challenge.blurb = "This is test challenge number %d" % i
-        challenge.description = "This describes challenge %d in detail" % i
-        challenge.help = challenge_help_test
-        challenge.instruction = challenge_instruction_test
-        # have bounding boxes for all but the first two challenges.
-        if i > 2:
-            minx = random.randrange(-120, -40)
-            miny = random.randrange(20, 50)
-            maxx = minx + 1
-            maxy = miny + 1
-            challengepoly = box(minx, miny, maxx, maxy)
-            print("\tChallenge has a bounding box of ", challengepoly)
-            challenge.polygon = challengepoly
-        db.session.add(challenge)
-
-        # add some tasks to the challenge
-        print("\tGenerating %i tasks for challenge %i" % (int(tasks), i))
-        # generate NUM_TASKS random tasks
-        for j in range(int(tasks)):
-            # generate a unique identifier
-            identifier = str(uuid.uuid4())
-            # create two random points not too far apart
-            task_geometries = []
-            p1 = Point(
-                random.randrange(minx, maxx) + random.random(),
-                random.randrange(miny, maxy) + random.random())
-            p2 = Point(
-                p1.x + (random.random() * random.choice((1, -1)) * 0.01),
-                p1.y + (random.random() * random.choice((1, -1)) * 0.01))
-            # create a linestring connecting the two points
-            # no constructor for linestring from points?
-            l1 = LineString([(p1.x, p1.y), (p2.x, p2.y)])
-            # add the first point and the linestring to the task's geometries
-            task_geometries.append(TaskGeometry(p1))
-            # set a linestring for every other challenge
-            if not j % 2:
-                task_geometries.append(TaskGeometry(l1))
-            # instantiate the task and register it with challenge 'test'
-            # Initialize a task with its challenge slug and persistent ID
-            task = Task(challenge.slug, identifier, task_geometries)
-            # because we are not using the API, we need to call set_location
-            # explicitly to set the task's location
-            task.set_location()
-            # generate random string for the instruction
-            task.instruction = task_instruction_text
-            # set a status
-            action = Action(random.choice(statuses),
-                            user_id=random.choice(range(int(users))))
-            task.append_action(action)
-            # add the task to the session
-            db.session.add(task)
-
-    # commit the generated tasks and the challenge to the database.
-    db.session.commit()
+def create_testdata(challenges=10, tasks=100, users=10, seed=0, days=365,
+                    end=None):
+    """Creates test data in the database, replacing all challenges, tasks
+    and users. The data is written with COPY, so millions of tasks are
+    feasible, and the same seed gives the same data. The action history
+    runs up to 'end' (a UTC datetime, or 'now' for the current time),
+    which defaults to a fixed time so that the data does not change
+    from run to run."""
+    from maproulette.testdata import TestDataGenerator
+    from dateutil import parser as dateparser
+    from datetime import datetime
+
+    if end == 'now':
+        end = datetime.utcnow()
+    elif end is not None:
+        end = dateparser.parse(end)
+    counts = TestDataGenerator(
+        challenges=int(challenges),
+        tasks=int(tasks),
+        users=int(users),
+        seed=int(seed),
+        days=int(days),
+        end=end).run()
+    print('done. %i tasks, %i task geometries and %i actions created' % (
+        counts['tasks'], counts['geometries'], counts['actions']))
 
 
 @manager.command
-def clean_stale_tasks():
+def load_tasks(challenge, filename):
+    """Loads tasks for a challenge from a JSON file with a list of tasks,
+    in the admin API format, using COPY"""
+    from maproulette.bulkload import TaskLoader
+    from maproulette.helpers import challenge_exists, json_tasks
 
-    from maproulette import db
-    from maproulette.models import Task, Action
-    from sqlalchemy.sql.functions import max
-    from datetime import datetime, timedelta
-    import pytz
+    if not challenge_exists(challenge):
+        print('challenge %s does not exist' % challenge)
+        return
+    loader = TaskLoader(challenge)
+    with open(filename, 'rb') as f:
+        loader.add_json_many(
+            json_tasks(f), processes=app.config.get('BULK_LOAD_PROCESSES'))
+    result = loader.load()
+    print('done. %i tasks created, %i tasks updated' %
+          (result['created'], result['updated']))
+
+
+@manager.command
+def clean_stale_tasks(interval=0):
+    """Makes tasks whose lease has run out available again.
+    With an interval (in seconds), keeps doing so until interrupted."""
+
+    import time
+    from maproulette.helpers import release_stale_tasks
+
+    while True:
+        counter = release_stale_tasks()
+        print('done. %i tasks made available' % counter)
+        if not int(interval):
+            break
+        time.sleep(int(interval))
+
+
+@manager.command
+def run_import_jobs(interval=None):
+    """Runs the bulk task imports queued on this host through the admin
+    API. With an interval (in seconds), keeps checking for new jobs
+    until interrupted, otherwise stops when there are none left."""
+
+    import time
+    from maproulette.jobs import claim_import_job, run_import_job, \
+        fail_interrupted_jobs
+
+    if interval is None:
+        interval = app.config.get('IMPORT_JOBS_INTERVAL', 5)
+    counter = fail_interrupted_jobs()
+    if counter:
+        print('%i interrupted jobs marked as failed' % counter)
+    while True:
+        job = claim_import_job()
+        if job is not None:
+            run_import_job(job)
+            print('job %i %s' % (job.id, job.status))
+            continue
+        if not int(interval):
+            break
+        time.sleep(int(interval))
+
+
+@manager.command
+def update_metrics(interval=0, rebuild=False):
+    """Updates the metrics tables with the actions since the last update.
+    With --rebuild, rebuilds them from all actions first. With an interval
+    (in seconds), keeps updating until interrupted."""
+
+    import time
+    from maproulette.metrics import update_metrics, rebuild_metrics
+
+    if rebuild:
+        counter = rebuild_metrics()
+        print('done. Metrics rebuilt from %i actions' % counter)
+    while True:
+        counter = update_metrics()
+        print('done. %i actions added to the metrics' % counter)
+        if not int(interval):
+            break
+        time.sleep(int(interval))
 
-    current_time = datetime.now(pytz.utc)
-    stale_threshold = current_time - timedelta(hours=1)
-    counter = 0
 
-    for task in db.session.query(Task).filter(
-        Task.status.in_(['assigned', 'editing'])).join(
-        Task.actions).group_by(
-            Task.identifier, Task.challenge_slug).having(max(Action.timestamp) < stale_threshold).all():
-        task.append_action(Action("available"))
-        db.session.add(task)
-        print("setting task %s to available" % (task.identifier))
-        counter += 1
-    db.session.commit()
-    print('done. %i tasks made available' % counter)
+@manager.command
+def export_actions(output='-', format='ndjson', challenge=None, user=None,
+                   start=None, end=None):
+    """Exports the actions, with the identifiers and challenges of their
+    tasks, as newline delimited JSON or CSV (--format csv), to a file
+    (--output) or to stdout. The actions can be limited to a challenge
+    (by slug), a user (by id), and a start and end time (yyyymmddhhmm)."""
+
+    from maproulette.export import export_actions, EXPORT_FORMATS
+    from dateutil import parser as dateparser
+
+    if format not in EXPORT_FORMATS:
+        print('unknown format %s, use ndjson or csv' % format)
+        return
+    formatter = EXPORT_FORMATS[format][0]
+    chunks = export_actions(
+        challenge,
+        int(user) if user is not None else None,
+        dateparser.parse(start) if start is not None else None,
+        dateparser.parse(end) if end is not None else None)
+    out = sys.stdout if output == '-' else open(output, 'wb')
+    try:
+        for chunk in formatter(chunks):
+            out.write(chunk)
+    finally:
+        if out is not sys.stdout:
+            out.close()
+            print('done. Actions exported to %s' % output)
 
 
 @manager.command
-def populate_task_location():
-    """This command populates the new location field for each task"""
+def repair_status_counts(challenge=None):
+    """Recounts the tasks per status, and per grid tile and status, for a
+    challenge, or for all challenges.
+    The counts are kept up to date by triggers, so this is only needed if
+    they were changed by hand, or after the triggers were first added."""
+
+    from maproulette.helpers import repair_status_counts
+
+    counter = repair_status_counts(challenge)
+    print('done. %i status counts stored' % counter)
+
+
+@manager.command
+def populate_task_location(batch=10000,
+                           checkpoint='populate_task_location.checkpoint',
+                           overwrite=False):
+    """This command populates the location field for each task.
+    The locations are computed in the database, for batches of task ids
+    at a time. The last finished batch is kept in the checkpoint file,
+    so an interrupted run picks up where it left off. Only tasks
+    without a location are updated, unless --overwrite is given."""
     from maproulette import db
-    from maproulette.models import Task, Challenge
-    for challenge in db.session.query(Challenge):
-        counter = 0
-        for task in db.session.query(Task).filter_by(
-                challenge_slug=challenge.slug):
-            task.set_location()
-            counter += 1
-            # commit every 1000
-            if not counter % 1000:
-                db.session.commit()
+    from maproulette.models import Task
+    from sqlalchemy import func, text
+
+    # the representative point of all coordinates of the task
+    # geometries, like Task.set_location calculates it.
+    statement = text("""
+        UPDATE tasks SET location = l.location
+        FROM (
+            SELECT g.task_id,
+                ST_SetSRID(ST_PointOnSurface(ST_Collect(p.geom)), 4326)
+                    AS location
+            FROM task_geometries g, LATERAL ST_DumpPoints(g.geom) p
+            WHERE g.task_id >= :start AND g.task_id < :end
+            GROUP BY g.task_id
+        ) l
+        WHERE tasks.id = l.task_id
+            AND (tasks.location IS NULL OR :overwrite)""")
+
+    batch = int(batch)
+    start = 0
+    if os.path.exists(checkpoint):
+        with open(checkpoint) as f:
+            start = int(f.read())
+        print('resuming from task id %i' % start)
+    last_id = db.session.query(func.max(Task.id)).scalar() or 0
+    counter = 0
+    while start <= last_id:
+        result = db.session.execute(statement, {
+            'start': start,
+            'end': start + batch,
+            'overwrite': bool(overwrite)})
         db.session.commit()
-        print('done. Location for %i tasks in challenge %s set' %\
-            (counter, challenge.title))
+        counter += result.rowcount
+        start += batch
+        with open(checkpoint, 'w') as f:
+            f.write(str(start))
+        print('%i tasks done, up to task id %i' % (counter, start))
+    if os.path.exists(checkpoint):
+        os.remove(checkpoint)
+    print('done. Location for %i tasks set' % counter)
 
 
 @manager.command
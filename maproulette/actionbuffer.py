@@ -0,0 +1,92 @@
+"""A buffer for writing task actions in bulk"""
+
+from maproulette import app, db
+from maproulette.models import Action
+from threading import Lock, Thread
+import atexit
+import time
+
+
+action_buffer = None
+action_buffer_lock = Lock()
+
+
+def get_action_buffer():
+    """Return the action buffer for this process, starting it if needed"""
+
+    global action_buffer
+    with action_buffer_lock:
+        if action_buffer is None:
+            action_buffer = ActionBuffer(
+                interval=app.config.get('ACTION_BUFFER_INTERVAL', 2),
+                max_size=app.config.get('ACTION_BUFFER_MAX_SIZE', 1000))
+            action_buffer.start()
+        return action_buffer
+
+
+class ActionBuffer(object):
+
+    """Collects actions from many requests and inserts them in bulk.
+
+    Actions are flushed by a background thread every 'interval'
+    seconds, or right away when 'max_size' actions are waiting. This
+    only defers the actions table: callers should update the task
+    status themselves, so that tasks are not handed out again in
+    the meantime."""
+
+    def __init__(self, interval=2, max_size=1000):
+        self.interval = interval
+        self.max_size = max_size
+        self.rows = []
+        self.lock = Lock()
+
+    def add(self, task_id, action):
+        """Queue an action for the task with the given id"""
+
+        with self.lock:
+            self.rows.append({
+                'timestamp': action.timestamp,
+                'user_id': action.user_id,
+                'task_id': task_id,
+                'status': action.status,
+                'editor': action.editor})
+            full = len(self.rows) >= self.max_size
+        if full:
+            self.flush()
+
+    def flush(self):
+        """Insert all queued actions with a single statement"""
+
+        with self.lock:
+            rows, self.rows = self.rows, []
+        if not rows:
+            return
+        try:
+            with db.engine.begin() as connection:
+                connection.execute(Action.__table__.insert(), rows)
+        except Exception as e:
+            app.logger.warn(e)
+            # insert the actions one by one, so that one bad action
+            # (for a task deleted in the meantime, say) does not take
+            # the others down with it
+            for row in rows:
+                try:
+                    with db.engine.begin() as connection:
+                        connection.execute(Action.__table__.insert(), row)
+                except Exception as e:
+                    app.logger.warn('could not store action {row}: {e}'.format(
+                        row=row, e=e))
+        app.logger.debug('flushed {n} actions'.format(n=len(rows)))
+
+    def run(self):
+        while True:
+            time.sleep(self.interval)
+            self.flush()
+
+    def start(self):
+        """Start flushing in a background thread, and once more on exit"""
+
+        thread = Thread(target=self.run)
+        thread.daemon = True
+        thread.start()
+        atexit.register(self.flush)
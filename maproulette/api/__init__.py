@@ -3,18 +3,35 @@ from flask_restful import reqparse, fields, marshal, \
     marshal_with, Api, Resource, abort
 from flask_restful.fields import Raw
 from flask_restful.utils import cors
-from flask import session, request, url_for
-from maproulette.helpers import get_random_task,\
-    get_challenge_or_404, get_task_or_404, get_task_or_none, osmerror, \
-    json_to_task, geojson_to_task, refine_with_user_area, user_area_is_defined,\
-    send_email, as_stats_dict, challenge_exists, requires_auth, requires_token
-from maproulette.models import Challenge, Task, Action, User, db
+from flask import session, request, url_for, Response, \
+    stream_with_context
+from maproulette.helpers import get_random_task, claim_random_task,\
+    claim_task, nearest_task_query, get_random_tasks, set_task_status,\
+    get_challenge_or_404, get_task_or_404, osmerror, \
+    get_or_abort, get_status_counts, area_status_counts,\
+    json_to_task,\
+    refine_with_user_area,\
+    user_area_is_defined,\
+    send_email, as_stats_dict, challenge_exists, requires_auth, \
+    requires_token, RESOLUTIONS, bucket_start, choose_resolution, \
+    count_buckets, period_start
+from maproulette.models import Challenge, Task, TaskGeometry, Action, User, \
+    ImportJob, AVAILABLE_STATUSES, LEADERBOARD_PERIODS, db
+from maproulette.jobs import enqueue_import
+from maproulette.metrics import hourly_cutoff
+from maproulette.export import export_actions, start_export, \
+    finish_export, EXPORT_FORMATS
+from maproulette.statscache import cached_stats, get_stats_cache
 from geoalchemy2.functions import ST_Buffer
 from geoalchemy2.shape import to_shape
 from sqlalchemy import func
 from sqlalchemy.exc import IntegrityError
+from sqlalchemy.orm import joinedload
+from datetime import datetime
+from collections import namedtuple
 import geojson
 import json
+import pytz
 import re
 
 message_internal_server_error = 'Something really unexpected happened...'
@@ -76,11 +93,85 @@ action_fields = {
     'user': fields.String(attribute='user_id')
 }
 
+job_fields = {
+    'id': fields.Integer,
+    'challenge': fields.String(attribute='challenge_slug'),
+    'kind': fields.String,
+    'status': fields.String,
+    'created': fields.DateTime,
+    'started': fields.DateTime,
+    'finished': fields.DateTime,
+    'rows': fields.Integer,
+    'size': fields.Integer,
+    'bytes_read': fields.Integer,
+    'error': fields.String
+}
+
 user_summary = {
     'id': fields.Integer,
     'display_name': fields.String
 }
 
+
+# a task geometry as returned with a claimed task (see claim_tasks)
+ClaimedGeometry = namedtuple('ClaimedGeometry', ['osmid', 'geometry'])
+
+
+def geometries_to_geojson(geometries):
+    """Return task geometries as a GeoJSON FeatureCollection"""
+    return geojson.FeatureCollection([geojson.Feature(
+        geometry=g.geometry,
+        properties={
+            'selected': True,
+            'osmid': g.osmid}) for g in geometries])
+
+
+def marshal_task(task, geometries=None):
+    """Marshal a task, adding its geometries if they are given"""
+    result = marshal(task, task_fields)
+    if geometries is not None:
+        result['geometries'] = geometries_to_geojson(geometries)
+    return result
+
+
+def marshal_job(job):
+    """Marshal an import job, adding its progress and throughput"""
+    result = marshal(job, job_fields)
+    result['progress'] = float(job.bytes_read or 0) / job.size \
+        if job.size else None
+    result['rows_per_second'] = None
+    if job.started:
+        end = job.finished or datetime.now(pytz.utc).replace(tzinfo=None)
+        seconds = (end - job.started).total_seconds()
+        if seconds > 0:
+            result['rows_per_second'] = job.rows / seconds
+    result['result'] = json.loads(job.result) if job.result else None
+    return result
+
+
+def enqueue_or_abort(slug, kind):
+    """Queue an import job for the request body, and return the
+    response pointing the client to the job's progress"""
+    get_challenge_or_404(slug, abort_if_inactive=False)
+    try:
+        job = enqueue_import(slug, kind, request.stream)
+    except Exception as e:
+        app.logger.warn(e)
+        abort(500, message=message_internal_server_error)
+    url = url_for('adminapiimportjob', job_id=job.id)
+    return {'job': job.id, 'url': url}, 202, {'Location': url}
+
+
+def include_geometries():
+    """Whether the request asks for task geometries
+    to be included with the task (?include=geometries)"""
+    parser = reqparse.RequestParser()
+    parser.add_argument('include', type=str,
+                        help='include could not be parsed')
+    include = parser.parse_args()['include'] or ''
+    return 'geometries' in include.split(',')
+
+
 api = Api(app)
 api.decorators = [cors.crossdomain(origin=app.config['METRICS_URL'])]
 
@@ -219,28 +310,48 @@ class ApiChallengeSummaryStats(Resource):
     """Challenge Statistics endpoint"""
 
     def get(self, challenge_slug):
-        """Return statistics for the challenge identified by 'slug'"""
+        """Return statistics for the challenge identified by 'slug'.
+        Within a user defined editing area, the numbers are estimated
+        from the task counts per grid tile, unless ?exact=1 is given."""
         # get the challenge
         challenge = get_challenge_or_404(challenge_slug, abort_if_inactive=False)
 
-        # query the number of tasks
-        query = db.session.query(Task).filter_by(challenge_slug=challenge.slug)
-        # refine with the user defined editing area
-        query = refine_with_user_area(query)
-        # emit count
-        total = query.count()
+        parser = reqparse.RequestParser()
+        parser.add_argument('exact', type=int, default=0,
+                            help='exact could not be parsed')
+        args = parser.parse_args()
 
-        # get the approximate number of available tasks
-        unfixed = query.filter(Task.status.in_(
-            ['available', 'created', 'skipped'])).count()
+        # without a user defined editing area, the numbers
+        # come straight from the task counts per status
+        if not user_area_is_defined():
+            counts = get_status_counts(challenge.slug)
+        elif not args.exact:
+            counts = area_status_counts(
+                challenge.slug,
+                session['lon'],
+                session['lat'],
+                session['radius'])
+        else:
+            # count the tasks in the user defined editing area by status
+            query = db.session.query(
+                Task.status,
+                func.count(Task.id)).filter_by(
+                challenge_slug=challenge.slug).group_by(Task.status)
+            query = refine_with_user_area(query)
+            counts = dict(query.all())
 
-        return {'total': total, 'unfixed': unfixed}
+        return {
+            'total': sum(counts.values()),
+            'unfixed': sum(counts.get(status, 0)
+                           for status in AVAILABLE_STATUSES),
+            'approximate': user_area_is_defined() and not args.exact}
 
 
 class ApiStats(Resource):
 
     """Statistics Endpoint"""
 
+    @cached_stats
     def get(self, challenge_slug=None, user_id=None):
         from dateutil import parser as dateparser
         from datetime import datetime
@@ -310,11 +421,12 @@ class ApiStats(Resource):
 
 class ApiStatsHistory(Resource):
 
-    """Day to day history overall"""
+    """History overall, by hour, day, week or month"""
 
+    @cached_stats
     def get(self, challenge_slug=None, user_id=None):
 
-        from maproulette.models import HistoricalMetrics as HM
+        from maproulette.models import HistoricalMetrics, MetricsRollup
 
         start = None
         end = None
@@ -326,38 +438,209 @@ class ApiStatsHistory(Resource):
                             help='start datetime yyyymmddhhmm')
         parser.add_argument('end', type=str,
                             help='end datetime yyyymmddhhmm')
+        parser.add_argument('resolution', type=str, default='auto',
+                            choices=['auto'] + [r for r, s in RESOLUTIONS],
+                            help='hour, day, week, month or auto')
 
         args = parser.parse_args()
 
-        stats_query = db.session.query(
+        # time slicing filters
+        if args['start'] is not None:
+            start = dateparser.parse(args['start'])
+            if args['end'] is None:
+                end = datetime.utcnow()
+            else:
+                end = dateparser.parse(args['end'])
+            span = (start, end)
+        else:
+            # the whole history, from the first day with metrics
+            first = self.filter(db.session.query(
+                func.min(HistoricalMetrics.timestamp)),
+                HistoricalMetrics, challenge_slug, user_id).scalar()
+            if first is None:
+                return {}
+            span = (first, datetime.utcnow())
+
+        # keep the number of buckets within STATS_HISTORY_MAX_POINTS
+        max_points = app.config.get('STATS_HISTORY_MAX_POINTS', 400)
+        resolution = args['resolution']
+        if resolution == 'auto':
+            resolution = choose_resolution(
+                span[0], span[1], max_points, hourly_cutoff())
+        elif resolution == 'hour' and span[0] < hourly_cutoff():
+            # the older hourly rollups have been pruned
+            abort(400, message='Hourly statistics are only kept for the '
+                  'last {} days, use a coarser resolution or a later '
+                  'start'.format(app.config.get('METRICS_HOURLY_DAYS', 14)))
+        elif count_buckets(span[0], span[1], resolution) > max_points:
+            abort(400, message='More than {} points by {}, use a coarser '
+                  'resolution or a shorter time span'.format(
+                      max_points, resolution))
+
+        # the daily metrics are the historical metrics, the others
+        # are in the rollups
+        HM = HistoricalMetrics
+        if resolution != 'day':
+            HM = MetricsRollup
+
+        stats_query = self.filter(db.session.query(
             HM.timestamp,
             HM.status,
-            func.sum(HM.count))
+            func.sum(HM.count)), HM, challenge_slug, user_id)
 
-        if challenge_slug is not None:
-            stats_query = stats_query.filter(HM.challenge_slug == challenge_slug)
-        if user_id is not None:
-            stats_query = stats_query.filter(HM.user_id == user_id)
+        if HM is MetricsRollup:
+            stats_query = stats_query.filter(HM.resolution == resolution)
 
         stats_query = stats_query.group_by(
             HM.timestamp, HM.status).order_by(
             HM.status)
 
-        # time slicing filters
-        if args['start'] is not None:
-            start = dateparser.parse(args['start'])
-            if args['end'] is None:
-                end = datetime.utcnow()
-            else:
-                end = dateparser.parse(args['end'])
-            stats_query = stats_query.filter(
-                Action.timestamp.between(start, end))
+        if start is not None:
+            stats_query = stats_query.filter(HM.timestamp.between(
+                bucket_start(start, resolution), end))
 
         return as_stats_dict(
             stats_query.all(),
             order=[1, 0, 2],
             start=start,
-            end=end)
+            end=end,
+            resolution=resolution)
+
+    @staticmethod
+    def filter(query, model, challenge_slug, user_id):
+        if challenge_slug is not None:
+            query = query.filter(model.challenge_slug == challenge_slug)
+        if user_id is not None:
+            query = query.filter(model.user_id == user_id)
+        return query
+
+
+class ApiLeaderboard(Resource):
+
+    """Leaderboard endpoint"""
+
+    @cached_stats
+    def get(self, challenge_slug=None):
+        """Returns a page of the users with the highest scores, overall
+        or for a challenge, over all time or for a month, week or day"""
+
+        from maproulette.models import LeaderboardScore as LS
+
+        from dateutil import parser as dateparser
+        from datetime import datetime
+        parser = reqparse.RequestParser()
+        parser.add_argument('period', type=str, default='all',
+                            choices=LEADERBOARD_PERIODS,
+                            help='all, month, week or day')
+        parser.add_argument('start', type=str,
+                            help='datetime yyyymmddhhmm in the period, '
+                            'defaults to now')
+        parser.add_argument('limit', type=int, default=10,
+                            help='number of users')
+        parser.add_argument('offset', type=int, default=0,
+                            help='number of users to skip')
+        args = parser.parse_args()
+
+        max_limit = app.config.get('LEADERBOARD_MAX_LIMIT', 100)
+        if not 0 < args.limit <= max_limit:
+            abort(400, message='limit must be between 1 and {}'.format(
+                max_limit))
+        if args.offset < 0:
+            abort(400, message='offset can not be negative')
+
+        date = datetime.utcnow()
+        if args.start is not None:
+            date = dateparser.parse(args.start)
+        start = period_start(args.period, date)
+
+        scores = db.session.query(
+            LS.user_id,
+            LS.user_name,
+            LS.score).filter(
+            LS.period == args.period,
+            LS.period_start == start,
+            LS.challenge_slug == (challenge_slug or '')).order_by(
+            LS.score.desc(), LS.user_id).offset(
+            args.offset).limit(args.limit)
+
+        return {
+            'period': args.period,
+            'start': start.isoformat(),
+            'offset': args.offset,
+            'leaders': [{
+                'rank': args.offset + n + 1,
+                'user_id': user_id,
+                'user_name': user_name,
+                'score': score}
+                for n, (user_id, user_name, score)
+                in enumerate(scores.all())]}
+
+
+class ApiExportActions(Resource):
+
+    """Action history export endpoint"""
+
+    @requires_auth
+    def get(self):
+        """Streams the actions, with the identifiers and challenges of
+        their tasks, as newline delimited JSON or as CSV"""
+
+        from dateutil import parser as dateparser
+        parser = reqparse.RequestParser()
+        parser.add_argument('format', type=str, default='ndjson',
+                            choices=sorted(EXPORT_FORMATS),
+                            help='ndjson or csv')
+        parser.add_argument('challenge', type=str,
+                            help='challenge slug')
+        parser.add_argument('user', type=int,
+                            help='user id')
+        parser.add_argument('start', type=str,
+                            help='start datetime yyyymmddhhmm')
+        parser.add_argument('end', type=str,
+                            help='end datetime yyyymmddhhmm')
+        args = parser.parse_args()
+
+        if args.challenge is not None and \
+                not challenge_exists(args.challenge):
+            abort(404, message='No challenge {}'.format(args.challenge))
+        start = end = None
+        if args.start is not None:
+            start = dateparser.parse(args.start)
+        if args.end is not None:
+            end = dateparser.parse(args.end)
+
+        if not start_export():
+            abort(429, message='Too many exports running, try again later')
+        try:
+            formatter, mimetype = EXPORT_FORMATS[args.format]
+            chunks = export_actions(args.challenge, args.user, start, end)
+            # without a content length, the response is sent chunked
+            response = Response(
+                stream_with_context(formatter(chunks)),
+                mimetype=mimetype,
+                headers={'Content-Disposition':
+                         'attachment; filename=actions.{}'.format(
+                             args.format)})
+        except Exception:
+            finish_export()
+            raise
+        # the export runs until the response has been sent
+        response.call_on_close(finish_export)
+        return response
+
+
+class ApiStatsCache(Resource):
+
+    """Statistics cache endpoint"""
+
+    def get(self):
+        """Return the hits, misses and size of the statistics
+        response cache of the worker that handles the request"""
+        stats = get_stats_cache().stats()
+        stats['version'] = [
+            v.isoformat() if isinstance(v, datetime) else v
+            for v in stats['version'] or ()]
+        return stats
 
 
 class ApiChallengeTask(Resource):
@@ -380,15 +663,27 @@ class ApiChallengeTask(Resource):
         lon = args['lon']
         lat = args['lat']
 
+        with_geometries = include_geometries()
         task = None
-        if lon and lat:
-            coordWKT = 'POINT(%s %s)' % (lat, lon)
-            task = Task.query.filter(Task.location.ST_Intersects(
-                ST_Buffer(coordWKT, app.config["NEARBUFFER"]))).first()
+        if lon is not None and lat is not None:
+            # get the available task closest to the given location
+            q = nearest_task_query(challenge, lon, lat)
+            if assign:
+                task = claim_task(q, osmid, with_geometries=with_geometries)
+            elif with_geometries:
+                task = q.options(joinedload(Task.geometries)).first()
+            else:
+                task = q.first()
         if task is None:  # we did not get a lon/lat or there was no task close
             # If no location is specified, or no tasks were found, gather
-            # random tasks
-            task = get_random_task(challenge)
+            # random tasks. When assigning, the task is claimed and
+            # assigned in a single statement.
+            if assign:
+                task = claim_random_task(
+                    challenge, osmid, with_geometries=with_geometries)
+            else:
+                task = get_random_task(
+                    challenge, with_geometries=with_geometries)
             # If no tasks are found with this method, then this challenge
             # is complete
         if task is None:
@@ -412,22 +707,50 @@ class ApiChallengeTask(Resource):
             # Is this the right error?
             return osmerror("ChallengeComplete",
                             "Challenge {} is complete".format(challenge.title))
-        if assign:
-            task.append_action(Action("assigned", osmid))
-            merged_t = db.session.merge(task)
-            db.session.add(merged_t)
-
-        try:
-            db.session.commit()
-        except Exception as e:
-            if type(e) == IntegrityError:
-                app.logger.warn(e)
-                db.session.rollback()
-                abort(409, message='The session and the database did not agree for task identifier {identifier}: {message}'.format(id=task.identifier, message=e))
+        geometries = None
+        if with_geometries:
+            if assign:
+                # an assigned task is a row that came with its geometries
+                geometries = [ClaimedGeometry(g['osmid'], g['geometry'])
+                              for g in task.geometries or []]
             else:
-                app.logger.warn(e)
-                abort(500, message=message_internal_server_error)
-        return marshal(task, task_fields)
+                geometries = task.geometries
+        return marshal_task(task, geometries)
+
+
+class ApiChallengeTasksNext(Resource):
+
+    """Upcoming tasks endpoint"""
+
+    def get(self, slug):
+        """Returns up to 'count' random tasks with their geometries for
+        the challenge identified by 'slug', so that the client can load
+        the next task while the current one is being worked on. The
+        tasks are assigned to the user unless assign=0 is passed."""
+        challenge = get_challenge_or_404(slug, True)
+        parser = reqparse.RequestParser()
+        parser.add_argument('count', type=int, default=1,
+                            help='count could not be parsed')
+        parser.add_argument('assign', type=int, default=1,
+                            help='Assign could not be parsed')
+        args = parser.parse_args()
+        count = args['count']
+        if count < 1 or count > app.config.get('MAX_TASKS_NEXT', 10):
+            abort(400, message='count should be between 1 and {}'.format(
+                app.config.get('MAX_TASKS_NEXT', 10)))
+
+        tasks = get_random_tasks(challenge,
+                                 count,
+                                 claim=bool(args['assign']),
+                                 osmid=session.get('osm_id'))
+
+        # get the geometries for all tasks at once
+        geometries = dict((task.id, []) for task in tasks)
+        if geometries:
+            for g in TaskGeometry.query.filter(
+                    TaskGeometry.task_id.in_(geometries.keys())):
+                geometries[g.task_id].append(g)
+        return [marshal_task(task, geometries[task.id]) for task in tasks]
 
 
 class ApiChallengeTaskDetails(Resource):
@@ -436,9 +759,14 @@ class ApiChallengeTaskDetails(Resource):
 
     def get(self, slug, identifier):
         """Returns non-geo details for the task identified by
-        'identifier' from the challenge identified by 'slug'"""
+        'identifier' from the challenge identified by 'slug'.
+        With ?include=geometries, the task geometries are returned
+        as well."""
+        if include_geometries():
+            task = get_task_or_404(slug, identifier, with_geometries=True)
+            return marshal_task(task, task.geometries)
         task = get_task_or_404(slug, identifier)
-        return marshal(task, task_fields)
+        return marshal_task(task)
 
     def put(self, slug, identifier):
         """Update the task identified by 'identifier' from
@@ -451,24 +779,19 @@ class ApiChallengeTaskDetails(Resource):
                             help="editor cannot be parsed")
         args = parser.parse_args()
 
-        # get the task
-        task = get_task_or_404(slug, identifier)
-        # append the latest action to it.
-        task.append_action(Action(args.action,
-                                  session.get('osm_id'),
-                                  args.editor))
-        merged_t = db.session.merge(task)
-        db.session.add(merged_t)
+        # set the task status and record the action in one go.
         try:
-            db.session.commit()
+            found = set_task_status(slug, identifier, Action(
+                args.action,
+                session.get('osm_id'),
+                args.editor))
         except Exception as e:
             if type(e) == IntegrityError:
-                app.logger.warn(e)
-                db.session.rollback()
-                abort(409, message='The session and the database did not agree for task identifier {identifier}: {message}'.format(id=task.identifier, message=e))
+                abort(409, message='The session and the database did not agree for task identifier {identifier}: {message}'.format(identifier=identifier, message=e))
             else:
-                app.logger.warn(e)
                 abort(500, message=message_internal_server_error)
+        if not found:
+            abort(404)
         return {}, 200
 
 
@@ -491,12 +814,7 @@ class ApiChallengeTaskGeometries(Resource):
         """Returns the geometries for the task identified by
         'identifier' from the challenge identified by 'slug'"""
         task = get_task_or_404(slug, identifier)
-        geometries = [geojson.Feature(
-            geometry=g.geometry,
-            properties={
-                'selected': True,
-                'osmid': g.osmid}) for g in task.geometries]
-        return geojson.FeatureCollection(geometries)
+        return geometries_to_geojson(task.geometries)
 
 
 class ApiUsers(Resource):
@@ -523,6 +841,13 @@ api.add_resource(ApiStats,
                  '/api/stats/challenge/<string:challenge_slug>/users',
                  '/api/stats/user/<int:user_id>',
                  '/api/stats/user/<int:user_id>/challenges')
+api.add_resource(ApiLeaderboard,
+                 '/api/stats/leaderboard',
+                 '/api/stats/challenge/<string:challenge_slug>/leaderboard')
+api.add_resource(ApiExportActions,
+                 '/api/stats/export')
+api.add_resource(ApiStatsCache,
+                 '/api/stats/cache')
 api.add_resource(ApiStatsHistory,
                  '/api/stats/history',
                  '/api/stats/challenge/<string:challenge_slug>/history',
@@ -534,6 +859,8 @@ api.add_resource(ApiChallengeSummaryStats,
 # task endpoints
 api.add_resource(ApiChallengeTask,
                  '/api/challenge/<slug>/task')
+api.add_resource(ApiChallengeTasksNext,
+                 '/api/challenge/<slug>/tasks/next')
 api.add_resource(ApiChallengeTaskDetails,
                  '/api/challenge/<slug>/task/<identifier>')
 api.add_resource(ApiChallengeTaskGeometries,
@@ -723,165 +1050,109 @@ class AdminApiUpdateTask(Resource):
     def delete(self, slug, identifier):
         """Delete a task"""
 
-        t = get_task_or_404(slug, identifier)
-        t.append_action(Action('deleted'))
-        merged_t = db.session.merge(t)
-        db.session.add(merged_t)
         try:
-            db.session.commit()
+            found = set_task_status(slug, identifier, Action('deleted'))
         except Exception as e:
             if type(e) == IntegrityError:
-                app.logger.warn(e)
-                db.session.rollback()
                 abort(409, message='the session and the database did not agree: {}'.format(e))
             else:
-                app.logger.warn(e)
                 abort(500, message=message_internal_server_error)
+        if not found:
+            abort(404)
         return {}, 204
 
 
 class AdminApiUpdateTasksFromGeoJSON(Resource):
 
-    """Bulk task create / update from GeoJSON endpoint"""
+    """Bulk task create / update from GeoJSON endpoint.
+
+    The GeoJSON is spooled to disk and stored by the import worker
+    (manage.py run_import_jobs), in chunks of tasks. Returns the id of
+    the import job, whose progress is at /api/admin/jobs/<id>. If the
+    upload turns out to be invalid halfway, the chunks before that
+    point have been stored."""
 
     @requires_auth
     def post(self, slug):
         """bulk create tasks"""
-
-        app.logger.debug('we expect geojson')
-        data = json.loads(request.data)
-        # if there are no features, bail
-        app.logger.debug(data)
-        if not isinstance(data, dict):
-            abort(400, message='We need a dictionary')
-        if not 'features' in data:
-            abort(400, message='no features in geoJSON')
-        # if there are too many features, bail
-        if len(data['features']) > app.config['MAX_TASKS_BULK_UPDATE']:
-            abort(400, message='more than the max number of allowed tasks ({})in bulk create'.format(app.config['MAX_TASKS_BULK_UPDATE']))
-        # create tasks from each feature
-        for feature in data['features']:
-            task = geojson_to_task(slug, feature)
-            if task is not None:
-                db.session.add(task)
-        # commit the tasks
-        db.session.commit()
-        return {}, 200
+        return enqueue_or_abort(slug, 'geojson')
 
     @requires_auth
     def put(self, slug):
         """bulk update tasks"""
-
-        app.logger.debug('we expect geojson')
-        data = json.loads(request.data)
-        # if there are no features, bail
-        app.logger.debug(data)
-        if not isinstance(data, dict):
-            abort(400, )
-        if not data['features']:
-            abort(400, message='no features in geoJSON')
-        # if there are too many features, bail
-        if len(data['features']) > app.config['MAX_TASKS_BULK_UPDATE']:
-            abort(400, message='more than the max number of allowed tasks ({})in bulk create'.format(app.config['MAX_TASKS_BULK_UPDATE']))
-        # create tasks from each feature
-        for feature in data['features']:
-            task = geojson_to_task(slug, feature)
-            if task is not None:
-                db.session.add(task)
-        # commit the tasks
-        db.session.commit()
-        return {}, 200
+        return enqueue_or_abort(slug, 'geojson')
 
 
 class AdminApiUpdateTasks(Resource):
 
-    """Bulk task create / update endpoint"""
+    """Bulk task create / update endpoint.
+
+    The tasks are spooled to disk and loaded by the import worker
+    (manage.py run_import_jobs). Returns the id of the import job,
+    whose progress is at /api/admin/jobs/<id>."""
 
     @requires_auth
     def post(self, slug):
-        """bulk create tasks"""
-
-        # Get the posted data
-        data = json.loads(request.data)
-        app.logger.debug(len(data))
-        app.logger.debug(app.config['MAX_TASKS_BULK_UPDATE'])
-
-        if len(data) > app.config['MAX_TASKS_BULK_UPDATE']:
-            abort(400, message='more than the max number of allowed tasks ({})in bulk create'.format(app.config['MAX_TASKS_BULK_UPDATE']))
-
-        # debug output number of tasks being posted
-        app.logger.debug('posting {number} tasks...'.format(number=len(data)))
-
-        for task in data:
-            app.logger.debug(task)
-            if not isinstance(task['identifier'], basestring):
-                app.logger.debug('identifier not a string')
-                abort(400, message='task identifier must exist and be string')
-            existingTask = get_task_or_none(slug, task['identifier'])
-            if existingTask is None:
-                if not re.match("^[\w\d_-]+$", task['identifier']):
-                    app.logger.debug('identifier should contain only a-z, A-Z, 0-9, _, -')
-                    abort(400, message='identifier should contain only a-z, A-Z, 0-9, _, -')
-                if 'geometries' not in task:
-                    app.logger.debug('new task must have geometries')
-                    abort(400, message='new task must have geometries')
-                t = json_to_task(slug, task)
-                db.session.add(t)
-                # commit all dirty tasks at once.
-            else:
-                app.logger.debug("Skipping task ({identifier}) as it already exists.".format(identifier=task['identifier']))
-        try:
-            db.session.commit()
-        except Exception as e:
-            if type(e) == IntegrityError:
-                app.logger.warn(e)
-                db.session.rollback()
-                abort(409, message='You tried to post a task ({identifier}) that already existed: {message}'.format(identifier=task['identifier'], message=e))
-            else:
-                app.logger.warn(e)
-                abort(500, message=message_internal_server_error)
-        return {}, 201
+        """bulk create tasks, skipping the ones that already exist"""
+        return enqueue_or_abort(slug, 'create')
 
     @requires_auth
     def put(self, slug):
-
         """bulk update"""
+        # the loader works out which tasks exist and need to be
+        # updated, and which are new and need to be created.
+        return enqueue_or_abort(slug, 'update')
 
-        # Get the data
-        data = json.loads(request.data)
 
-        # debug output number of tasks being put
-        app.logger.debug('putting {number} tasks...'.format(number=len(data)))
+class AdminApiImportJob(Resource):
 
-        if len(data) > app.config['MAX_TASKS_BULK_UPDATE']:
-            abort(400, message='more than 5000 tasks in bulk update')
+    """Import job progress endpoint"""
 
-        for task in data:
-            if not isinstance(task['identifier'], basestring):
-                abort(400, message='task identifier must exist and be string')
-            if not re.match("^[\w\d_-]+$", task['identifier']):
-                abort(400, message='identifier should contain only a-z, A-Z, 0-9, _, -')
-            existingTask = get_task_or_none(slug, task['identifier'])
-            if existingTask is None:
-                t = json_to_task(slug, task)
-            else:
-                t = json_to_task(slug,
-                                 task,
-                                 task=existingTask)
-            db.session.add(t)
+    @requires_auth
+    def get(self, job_id):
+        """Return the status, progress and outcome of an import job"""
+        return marshal_job(get_or_abort(ImportJob, job_id))
 
-        # commit all dirty tasks at once.
-        try:
-            db.session.commit()
-        except Exception as e:
-            if type(e) == IntegrityError:
-                app.logger.warn(e)
-                db.session.rollback()
-                abort(409, message='the session and the database did not agree: {}'.format(e))
-            else:
-                app.logger.warn(e)
-                abort(500, message=message_internal_server_error)
-        return {}, 200
+
+class AdminApiLoadTasks(Resource):
+
+    """Bulk task load endpoint.
+
+    Takes a list of tasks in the same format as the bulk create /
+    update endpoint, with no limit to the number of tasks. The tasks
+    are spooled to disk and written using COPY by the import worker
+    (manage.py run_import_jobs). Existing tasks are updated, new tasks
+    created. Returns the id of the import job, whose progress is at
+    /api/admin/jobs/<id>."""
+
+    @requires_auth
+    def post(self, slug):
+        """bulk load tasks"""
+        return enqueue_or_abort(slug, 'load')
+
+    @requires_auth
+    def put(self, slug):
+        """bulk load tasks"""
+        return enqueue_or_abort(slug, 'load')
+
+
+class AdminApiSyncTasks(Resource):
+
+    """Challenge task sync endpoint.
+
+    Takes the full list of tasks the challenge should have, in the same
+    format as the bulk create / update endpoint. The tasks are spooled
+    to disk and synced by the import worker (manage.py
+    run_import_jobs): new tasks are created, changed tasks updated,
+    and tasks that are not in the list are marked as deleted. Tasks
+    that were marked as false positives are left alone. Returns the id
+    of the import job, whose result at /api/admin/jobs/<id> has the
+    number of tasks created, updated, deleted and unchanged."""
+
+    @requires_auth
+    def put(self, slug):
+        """sync the challenge tasks"""
+        return enqueue_or_abort(slug, 'sync')
 
 api.add_resource(AdminApiChallenge,
                  '/api/admin/challenge/<string:slug>')
@@ -889,7 +1160,13 @@ api.add_resource(AdminApiTaskStatuses,
                  '/api/admin/challenge/<string:slug>/tasks')
 api.add_resource(AdminApiUpdateTasks,
                  '/api/admin/challenge/<string:slug>/tasks')
+api.add_resource(AdminApiLoadTasks,
+                 '/api/admin/challenge/<string:slug>/tasks/load')
+api.add_resource(AdminApiSyncTasks,
+                 '/api/admin/challenge/<string:slug>/tasks/sync')
 api.add_resource(AdminApiUpdateTasksFromGeoJSON,
                  '/api/admin/challenge/<string:slug>/tasksfromgeojson')
+api.add_resource(AdminApiImportJob,
+                 '/api/admin/jobs/<int:job_id>')
 api.add_resource(AdminApiUpdateTask,
                  '/api/admin/challenge/<string:slug>/task/<string:identifier>')
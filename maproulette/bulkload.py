@@ -0,0 +1,363 @@
+"""Bulk loading of tasks using PostgreSQL COPY"""
+
+from maproulette import app, db
+from maproulette.models import representative_point
+from shapely.geometry import asShape
+from sqlalchemy import text
+from datetime import datetime
+from itertools import islice
+from multiprocessing import Pool, cpu_count
+import hashlib
+import json
+import pytz
+import re
+import tempfile
+
+
+# the staging tables only live for the transaction that loads the tasks
+STAGING_TABLES = """
+CREATE TEMPORARY TABLE staged_tasks (
+    n integer PRIMARY KEY,
+    identifier varchar(72) NOT NULL,
+    instruction varchar,
+    status varchar,
+    location geometry,
+    has_geometries boolean NOT NULL,
+    content_hash varchar(32)
+) ON COMMIT DROP;
+CREATE TEMPORARY TABLE staged_task_geometries (
+    n integer NOT NULL,
+    osmid bigint,
+    geom geometry NOT NULL
+) ON COMMIT DROP;
+"""
+
+# if a task was staged more than once, the last one wins
+DEDUPLICATE = """
+DELETE FROM staged_tasks a USING staged_tasks b
+WHERE a.identifier = b.identifier AND a.n < b.n;
+DELETE FROM staged_task_geometries g
+WHERE NOT EXISTS (SELECT 1 FROM staged_tasks s WHERE s.n = g.n);
+ANALYZE staged_tasks;
+ANALYZE staged_task_geometries;
+"""
+
+# update the existing tasks, and record an action for the ones
+# that were given a status
+UPDATE_TASKS = """
+WITH updated AS (
+    UPDATE tasks SET
+        instruction = COALESCE(s.instruction, tasks.instruction),
+        status = COALESCE(s.status, tasks.status),
+        location = COALESCE(ST_SetSRID(s.location, 4326), tasks.location),
+        content_hash = COALESCE(s.content_hash, tasks.content_hash)
+    FROM staged_tasks s
+    WHERE tasks.challenge_slug = :slug AND tasks.identifier = s.identifier
+    RETURNING tasks.id, s.status
+), logged AS (
+    INSERT INTO actions (timestamp, task_id, status)
+    SELECT :timestamp, id, status FROM updated WHERE status IS NOT NULL
+)
+SELECT count(*) FROM updated
+"""
+
+# insert the new tasks together with their first action. tasks.id is
+# not the primary key, so it has no default and takes the sequence here.
+INSERT_TASKS = """
+WITH inserted AS (
+    INSERT INTO tasks
+        (id, identifier, challenge_slug, instruction, status, random,
+         location, content_hash)
+    SELECT nextval('tasks_id_seq'), s.identifier, :slug, s.instruction,
+        COALESCE(s.status, 'created'), random(),
+        ST_SetSRID(s.location, 4326), s.content_hash
+    FROM staged_tasks s
+    WHERE NOT EXISTS (
+        SELECT 1 FROM tasks t
+        WHERE t.challenge_slug = :slug AND t.identifier = s.identifier)
+    RETURNING id, status
+), logged AS (
+    INSERT INTO actions (timestamp, task_id, status)
+    SELECT :timestamp, id, status FROM inserted
+)
+SELECT count(*) FROM inserted
+"""
+
+# when syncing, soft delete the tasks that are no longer in the challenge,
+# except for the ones that were marked as false positives
+DELETE_MISSING_TASKS = """
+WITH deleted AS (
+    UPDATE tasks SET status = 'deleted', assigned_until = NULL
+    WHERE tasks.challenge_slug = :slug
+        AND tasks.status NOT IN ('deleted', 'falsepositive')
+        AND NOT EXISTS (
+            SELECT 1 FROM staged_tasks s WHERE s.identifier = tasks.identifier)
+    RETURNING tasks.id
+), logged AS (
+    INSERT INTO actions (timestamp, task_id, status)
+    SELECT :timestamp, id, 'deleted' FROM deleted
+)
+SELECT count(*) FROM deleted
+"""
+
+# when syncing, leave alone the tasks that have not changed (and
+# deleted tasks that have come back), as well as false positives.
+SKIP_UNCHANGED_TASKS = """
+WITH unchanged AS (
+    DELETE FROM staged_tasks s USING tasks t
+    WHERE t.challenge_slug = :slug AND t.identifier = s.identifier
+        AND ((t.content_hash IS NOT DISTINCT FROM s.content_hash
+              AND t.status != 'deleted')
+             OR t.status = 'falsepositive')
+    RETURNING s.n
+)
+SELECT count(*) FROM unchanged
+"""
+
+# when syncing, make deleted tasks that have come back available again
+RESTORE_DELETED_TASKS = """
+UPDATE staged_tasks s SET status = 'available' FROM tasks t
+WHERE t.challenge_slug = :slug AND t.identifier = s.identifier
+    AND t.status = 'deleted' AND s.status IS NULL
+"""
+
+# replace the geometries of the tasks that came with geometries
+REPLACE_GEOMETRIES = """
+DELETE FROM task_geometries USING tasks t, staged_tasks s
+WHERE task_geometries.task_id = t.id
+    AND t.challenge_slug = :slug AND t.identifier = s.identifier
+    AND s.has_geometries;
+INSERT INTO task_geometries (osmid, task_id, geom)
+SELECT g.osmid, t.id, g.geom
+FROM staged_task_geometries g
+    JOIN staged_tasks s ON s.n = g.n
+    JOIN tasks t ON t.challenge_slug = :slug AND t.identifier = s.identifier;
+"""
+
+
+def copy_value(value):
+    """Format a value for PostgreSQL's COPY text format"""
+
+    if value is None:
+        return u'\\N'
+    if isinstance(value, bool):
+        return u't' if value else u'f'
+    return u'{0}'.format(value).replace(
+        u'\\', u'\\\\').replace(
+        u'\t', u'\\t').replace(
+        u'\n', u'\\n').replace(
+        u'\r', u'\\r')
+
+
+def copy_row(values):
+    """Format a row for PostgreSQL's COPY text format"""
+
+    return (u'\t'.join(copy_value(v) for v in values) + u'\n').encode('utf-8')
+
+
+def prepare_shapes(shapes):
+    """Return the location (as WKB) and the (osmid, WKB) geometries to
+    stage for a list of (Shapely geometry, osmid) tuples"""
+
+    location = None
+    point = representative_point([shape for shape, osmid in shapes])
+    if point is not None:
+        location = point.wkb_hex
+    return location, [(osmid, shape.wkb_hex) for shape, osmid in shapes]
+
+
+def prepare_task(data):
+    """Parse and validate a task in the admin API task format, and return
+    the values to stage for it. This is CPU bound work only, so that it
+    can be done in the worker processes of a bulk load."""
+
+    identifier = data.get('identifier')
+    if not isinstance(identifier, basestring):
+        raise ValueError('task identifier must exist and be string')
+    if not re.match("^[\w\d_-]+$", identifier):
+        raise ValueError(
+            'identifier should contain only a-z, A-Z, 0-9, _, -')
+    location = None
+    geometries = None
+    content_hash = task_content_hash(data)
+    if 'geometries' in data:
+        shapes = []
+        for feature in data['geometries']['features']:
+            osmid = (feature.get('properties') or {}).get('osmid')
+            shape = asShape(feature['geometry'])
+            if shape.is_empty:
+                raise ValueError('task {} has an empty geometry'.format(
+                    identifier))
+            shapes.append((shape, osmid))
+        location, geometries = prepare_shapes(shapes)
+    return (identifier,
+            data.get('instruction'),
+            data.get('status'),
+            location,
+            geometries,
+            content_hash)
+
+
+class TaskLoader(object):
+
+    """Loads tasks for a challenge in bulk.
+
+    Tasks are staged to temporary files with add(), add_json() or
+    add_json_many(), and written to the database with load(). That
+    copies them into staging tables with COPY, and then updates the
+    existing tasks, inserts the new ones with their first action and
+    replaces the task geometries with a handful of set based
+    statements, all in one transaction."""
+
+    def __init__(self, challenge_slug):
+        self.challenge_slug = challenge_slug
+        spool_size = app.config.get('BULK_LOAD_SPOOL_SIZE', 16 * 1024 * 1024)
+        self.tasks = tempfile.SpooledTemporaryFile(max_size=spool_size)
+        self.geometries = tempfile.SpooledTemporaryFile(max_size=spool_size)
+        self.count = 0
+
+    def add(self, identifier, shapes=None, instruction=None, status=None,
+            content_hash=None):
+        """Stage a task. shapes is a list of (Shapely geometry, osmid)
+        tuples. If it is None, an existing task keeps its geometries."""
+
+        if not re.match("^[\w\d_-]+$", identifier):
+            raise ValueError(
+                'identifier should contain only a-z, A-Z, 0-9, _, -')
+        location = None
+        geometries = None
+        if shapes is not None:
+            location, geometries = prepare_shapes(shapes)
+        self.stage((identifier,
+                    instruction,
+                    status,
+                    location,
+                    geometries,
+                    content_hash))
+
+    def add_json(self, data):
+        """Stage a task in the admin API task format"""
+
+        self.stage(prepare_task(data))
+
+    def add_json_many(self, tasks, processes=1):
+        """Stage tasks in the admin API task format from an iterable.
+
+        With more than one process (None for one per core), the tasks
+        are parsed, validated and encoded in a pool of processes, taking
+        the tasks from the iterable in batches so that a streamed upload
+        is not read into memory at once. The pool forks the whole
+        process, so only the import job runner and manage.py use one,
+        and not the web workers."""
+
+        if processes == 1:
+            for data in tasks:
+                self.add_json(data)
+            return
+        processes = processes or cpu_count()
+        chunk_size = app.config.get('BULK_LOAD_CHUNK_SIZE', 100)
+        batch_size = chunk_size * processes * 4
+        pool = Pool(processes)
+        tasks = iter(tasks)
+        try:
+            for batch in iter(lambda: list(islice(tasks, batch_size)), []):
+                for prepared in pool.imap(prepare_task, batch, chunk_size):
+                    self.stage(prepared)
+        except Exception:
+            pool.terminate()
+            raise
+        else:
+            pool.close()
+        finally:
+            pool.join()
+
+    def stage(self, prepared):
+        """Write a prepared task to the staging files"""
+
+        (identifier, instruction, status,
+         location, geometries, content_hash) = prepared
+        if geometries is not None:
+            for osmid, geom in geometries:
+                self.geometries.write(copy_row([self.count, osmid, geom]))
+        self.tasks.write(copy_row([
+            self.count,
+            identifier,
+            instruction,
+            status,
+            location,
+            geometries is not None,
+            content_hash]))
+        self.count += 1
+
+    def load(self):
+        """Write the staged tasks to the database. Returns the number of
+        tasks created and updated."""
+
+        return self.write(sync=False)
+
+    def sync(self):
+        """Make the challenge's tasks match the staged tasks. Tasks that
+        were not staged are soft deleted, and only new and changed tasks
+        are written. Tasks marked as false positives are left alone.
+        Returns the number of tasks created, updated, deleted and left
+        unchanged."""
+
+        return self.write(sync=True)
+
+    def write(self, sync=False):
+        params = {
+            'slug': self.challenge_slug,
+            # store the timestamp as naive UTC time, like Action does
+            'timestamp': datetime.now(pytz.utc).replace(tzinfo=None)}
+        result = {}
+        try:
+            # COPY needs the DBAPI cursor, on the session's connection
+            # so that it is part of the same transaction
+            cursor = db.session.connection().connection.cursor()
+            cursor.execute(STAGING_TABLES)
+            self.tasks.seek(0)
+            cursor.copy_expert(
+                'COPY staged_tasks (n, identifier, instruction, status, '
+                'location, has_geometries, content_hash) FROM STDIN',
+                self.tasks)
+            self.geometries.seek(0)
+            cursor.copy_expert(
+                'COPY staged_task_geometries (n, osmid, geom) FROM STDIN',
+                self.geometries)
+            cursor.execute(DEDUPLICATE)
+            if sync:
+                result['deleted'] = db.session.execute(
+                    text(DELETE_MISSING_TASKS), params).scalar()
+                result['unchanged'] = db.session.execute(
+                    text(SKIP_UNCHANGED_TASKS), params).scalar()
+                db.session.execute(text(RESTORE_DELETED_TASKS), params)
+            result['updated'] = db.session.execute(
+                text(UPDATE_TASKS), params).scalar()
+            result['created'] = db.session.execute(
+                text(INSERT_TASKS), params).scalar()
+            db.session.execute(text(REPLACE_GEOMETRIES), params)
+            db.session.commit()
+        except Exception as e:
+            app.logger.warn(e)
+            db.session.rollback()
+            raise e
+        finally:
+            self.tasks.close()
+            self.geometries.close()
+        app.logger.debug('wrote tasks for {slug}: {result}'.format(
+            slug=self.challenge_slug, result=result))
+        return result
+
+
+def task_content_hash(data):
+    """Return a hash of the content of a task in the admin API task
+    format, for telling whether a task has changed. Tasks without
+    geometries are told apart by their instruction and status."""
+
+    content = {'instruction': data.get('instruction')}
+    if 'geometries' in data:
+        content['geometries'] = data['geometries']
+    else:
+        content['status'] = data.get('status')
+    content = json.dumps(content, sort_keys=True)
+    return hashlib.md5(content.encode('utf-8')).hexdigest()
@@ -0,0 +1,81 @@
+"""Per challenge task dispensers, holding a shuffled buffer of task ids"""
+
+from maproulette import app, db
+from maproulette.models import Task
+from random import random, shuffle
+from threading import Lock
+
+
+# the dispensers for this process, by challenge slug. These are not
+# persisted anywhere, so a restarted worker simply rebuilds them as
+# challenges are requested.
+dispensers = {}
+dispensers_lock = Lock()
+
+
+def get_dispenser(challenge_slug):
+    """Return the dispenser for a challenge, creating it if needed"""
+
+    with dispensers_lock:
+        if challenge_slug not in dispensers:
+            dispensers[challenge_slug] = TaskDispenser(
+                challenge_slug,
+                size=app.config.get('TASK_DISPENSER_SIZE', 500),
+                low_water=app.config.get('TASK_DISPENSER_LOW_WATER', 50))
+        return dispensers[challenge_slug]
+
+
+class TaskDispenser(object):
+
+    """Hands out the ids of available tasks for one challenge.
+
+    The ids are read in bulk from a random position in the idx_random
+    index, shuffled, and handed out from the end of the buffer. When the
+    buffer runs low it is topped up with a new batch. The ids handed out
+    are candidates only: the task may have been taken by another worker
+    in the meantime, so callers still need to check its status."""
+
+    def __init__(self, challenge_slug, size=500, low_water=50):
+        self.challenge_slug = challenge_slug
+        self.size = size
+        self.low_water = low_water
+        self.buffer = []
+        self.lock = Lock()
+
+    def __len__(self):
+        return len(self.buffer)
+
+    def next(self):
+        """Return the next task id, or None if there are none left"""
+
+        with self.lock:
+            if len(self.buffer) < self.low_water:
+                self.refill()
+            if not self.buffer:
+                return None
+            return self.buffer.pop()
+
+    def refill(self):
+        """Top up the buffer with a batch of available task ids"""
+
+        rn = random()
+        buffered = set(self.buffer)
+        ids = []
+        # read from the random value onwards, and wrap around to the
+        # start of the index if there were not enough tasks after it
+        for position in (Task.random >= rn, Task.random < rn):
+            limit = self.size - len(ids)
+            if limit <= 0:
+                break
+            q = db.session.query(Task.id).filter(
+                Task.challenge_slug == self.challenge_slug,
+                Task.is_available,
+                position).order_by(Task.random).limit(limit)
+            ids.extend(i for (i,) in q if i not in buffered)
+        shuffle(ids)
+        # put the new ids at the bottom so the ones
+        # already in the buffer are handed out first
+        self.buffer[:0] = ids
+        app.logger.debug('refilled dispenser for {slug} with {n} tasks'.format(
+            slug=self.challenge_slug,
+            n=len(ids)))
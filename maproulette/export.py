@@ -0,0 +1,129 @@
+"""Streaming export of the action history"""
+
+from maproulette import app, db
+from sqlalchemy import text
+from cStringIO import StringIO
+from datetime import datetime
+from threading import Lock
+import csv
+import json
+
+
+# the fields of an exported action
+EXPORT_COLUMNS = ['id', 'timestamp', 'user_id', 'user_name',
+                  'challenge_slug', 'task_identifier', 'status', 'editor']
+
+EXPORT_ACTIONS = """
+SELECT a.id, a.timestamp, a.user_id, u.display_name, t.challenge_slug,
+    t.identifier, a.status, a.editor
+FROM actions a
+    JOIN tasks t ON t.id = a.task_id
+    LEFT OUTER JOIN users u ON u.id = a.user_id
+WHERE {filters}
+ORDER BY a.id
+"""
+
+running_exports = 0
+running_exports_lock = Lock()
+
+
+def start_export():
+    """Count an export as running in this process and return True, or
+    return False if EXPORT_MAX_RUNNING exports are running already. Each
+    export holds a database connection from the pool while it streams."""
+
+    global running_exports
+    with running_exports_lock:
+        if running_exports >= app.config.get('EXPORT_MAX_RUNNING', 2):
+            return False
+        running_exports += 1
+        return True
+
+
+def finish_export():
+    """Count an export started with start_export as finished"""
+
+    global running_exports
+    with running_exports_lock:
+        running_exports -= 1
+
+
+def export_actions(challenge_slug=None, user_id=None, start=None, end=None):
+    """Yield the actions, optionally only those on a challenge, by a user,
+    or from start up to end, in lists of EXPORT_CHUNK_SIZE rows.
+
+    The rows are fetched from a server side cursor a chunk at a time, so
+    the memory used does not grow with the number of actions. This uses
+    its own connection rather than the session, as the export is streamed
+    after the request that started it has been torn down."""
+
+    filters = ['TRUE']
+    params = {}
+    if challenge_slug is not None:
+        filters.append('t.challenge_slug = :challenge_slug')
+        params['challenge_slug'] = challenge_slug
+    if user_id is not None:
+        filters.append('a.user_id = :user_id')
+        params['user_id'] = user_id
+    if start is not None:
+        filters.append('a.timestamp >= :start')
+        params['start'] = start
+    if end is not None:
+        filters.append('a.timestamp < :end')
+        params['end'] = end
+    query = text(EXPORT_ACTIONS.format(filters=' AND '.join(filters)))
+
+    chunk_size = app.config.get('EXPORT_CHUNK_SIZE', 1000)
+    connection = db.engine.connect().execution_options(stream_results=True)
+    try:
+        result = connection.execute(query, params)
+        while True:
+            rows = result.fetchmany(chunk_size)
+            if not rows:
+                break
+            yield rows
+    finally:
+        connection.close()
+
+
+def export_value(value):
+    if isinstance(value, datetime):
+        return value.isoformat()
+    return value
+
+
+def ndjson_chunks(chunks):
+    """Yield the chunks of actions as newline delimited JSON objects"""
+    for rows in chunks:
+        yield ''.join(
+            json.dumps(dict(zip(EXPORT_COLUMNS, map(export_value, row)))) +
+            '\n' for row in rows)
+
+
+def csv_value(value):
+    if value is None:
+        return ''
+    if isinstance(value, unicode):
+        return value.encode('utf-8')
+    return export_value(value)
+
+
+def csv_chunks(chunks):
+    """Yield a CSV header line, then the chunks of actions as CSV lines"""
+    f = StringIO()
+    writer = csv.writer(f)
+    writer.writerow(EXPORT_COLUMNS)
+    yield f.getvalue()
+    for rows in chunks:
+        f.seek(0)
+        f.truncate()
+        for row in rows:
+            writer.writerow([csv_value(value) for value in row])
+        yield f.getvalue()
+
+
+# the export formats, with the function that formats the chunks of
+# actions and the content type
+EXPORT_FORMATS = {
+    'ndjson': (ndjson_chunks, 'application/x-ndjson'),
+    'csv': (csv_chunks, 'text/csv')}
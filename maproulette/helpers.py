@@ -1,20 +1,46 @@
 """Some helper functions"""
 from flask import abort, session, request, make_response, Response
-from maproulette.models import Challenge, Task, TaskGeometry
+from maproulette.models import Challenge, Task, TaskGeometry, Action, \
+    ChallengeStatusCount, ChallengeTileCount, LEASED_STATUSES, TILE_SIZE, \
+    lease_expiry
 from maproulette.challengetypes import challenge_types
+from maproulette.dispenser import get_dispenser
+from maproulette.actionbuffer import get_action_buffer
 from functools import wraps
 import json
-from maproulette import app
-from shapely.geometry import MultiPoint, asShape, Point
+from maproulette import app, db
+from shapely.geometry import MultiPoint, asShape, Point, box
+from shapely.affinity import scale
+from shapely.prepared import prep
 from random import random
-from sqlalchemy.sql.expression import cast
+from sqlalchemy.sql.expression import cast, select, literal, type_coerce, \
+    and_
+from sqlalchemy.types import NullType
+from sqlalchemy.dialects.postgresql import JSON
+from sqlalchemy.orm import joinedload
+from sqlalchemy import func, text
 from geoalchemy2.functions import ST_DWithin
 from geoalchemy2.shape import from_shape
-from geoalchemy2.types import Geography
+from geoalchemy2.types import Geography, Geometry
 import requests
+import math
 from datetime import datetime, timedelta
+from decimal import Decimal
+import pytz
 from sqlalchemy.sql import compiler
 from psycopg2.extensions import adapt as sqlescape
+import importlib
+
+# the streaming JSON parser, using the yajl C library when it is installed,
+# as the pure Python backend is several times slower than json.loads
+for backend in ('yajl2_cffi', 'yajl2'):
+    try:
+        ijson = importlib.import_module('ijson.backends.' + backend)
+        break
+    except (ImportError, OSError):
+        pass
+else:
+    import ijson
 
 
 def signed_in():
@@ -62,26 +88,62 @@ def challenge_exists(challenge_slug):
     return True
 
 
-def get_task_or_404(challenge_slug, task_identifier):
+def get_task_or_404(challenge_slug, task_identifier, with_geometries=False):
     """Return a task based on its challenge and task identifier"""
 
-    t = get_task_or_none(challenge_slug, task_identifier)
+    t = get_task_or_none(challenge_slug, task_identifier, with_geometries)
     if t is None:
         abort(404)
     return t
 
 
-def get_task_or_none(challenge_slug, task_identifier):
-    """Return a task based on it's challenge and task identifier or none if not found"""
+def get_task_or_none(challenge_slug, task_identifier, with_geometries=False):
+    """Return a task based on it's challenge and task identifier or none if not found.
+
+    If with_geometries is True, the task geometries are loaded
+    in the same query."""
 
-    t = Task.query.filter(
+    q = Task.query.filter(
         Task.challenge_slug == challenge_slug).filter(
-        Task.identifier == task_identifier).first()
+        Task.identifier == task_identifier)
+    if with_geometries:
+        q = q.options(joinedload(Task.geometries))
+    t = q.first()
     if not t:
         return None
     return t
 
 
+def get_tasks_by_identifier(challenge_slug, identifiers, chunk_size=1000):
+    """Return a dictionary of the existing tasks of a challenge by
+    identifier, for a list of identifiers. The tasks are looked up
+    with one query per chunk_size identifiers."""
+
+    tasks = {}
+    identifiers = list(set(identifiers))
+    for i in range(0, len(identifiers), chunk_size):
+        for task in Task.query.filter(
+                Task.challenge_slug == challenge_slug,
+                Task.identifier.in_(identifiers[i:i + chunk_size])):
+            tasks[task.identifier] = task
+    return tasks
+
+
+def existing_identifiers(challenge_slug, identifiers, chunk_size=1000):
+    """Return the set of identifiers in a list that a task of the
+    challenge already has. Only the identifiers are queried, one query
+    per chunk_size identifiers."""
+
+    existing = set()
+    identifiers = list(set(identifiers))
+    for i in range(0, len(identifiers), chunk_size):
+        existing.update(identifier for identifier, in db.session.query(
+            Task.identifier).filter(
+            Task.challenge_slug == challenge_slug,
+            Task.identifier.in_(identifiers[i:i + chunk_size])))
+    return existing
+
+
 def task_exists(challenge_slug, task_identifier):
     q = Task.query.filter(
         Task.challenge_slug == challenge_slug).filter(
@@ -125,33 +187,341 @@ def local_or_whitelist_only(f):
     return decorator
 
 
-def get_random_task(challenge):
-    """Get a random task"""
+def dispense_task(challenge, claim=False, osmid=None, attempts=10,
+                  with_geometries=False):
+    """Get a task using the challenge's task dispenser.
+
+    The dispenser hands out ids from a buffer held in memory, so most
+    of the time this costs a single lookup (or claim) by primary key.
+    Ids whose task is no longer available are skipped. Returns None if
+    no task could be found this way, in which case the caller should
+    fall back to querying for a random task. If with_geometries is
+    True, the task geometries are loaded in the same query."""
+
+    # the dispenser buffer is challenge wide, so it cannot be used
+    # when the user has restricted the area they want to work in.
+    if user_area_is_defined():
+        return None
+    dispenser = get_dispenser(challenge.slug)
+    for attempt in range(attempts):
+        task_id = dispenser.next()
+        if task_id is None:
+            return None
+        q = Task.query.filter(Task.id == task_id,
+                              Task.is_available)
+        if claim:
+            task = claim_task(q, osmid, with_geometries=with_geometries)
+        elif with_geometries:
+            task = q.options(joinedload(Task.geometries)).first()
+        else:
+            task = q.first()
+        if task is not None:
+            return task
+    return None
+
+
+def random_task_queries(challenge):
+    """Return the queries for available tasks starting from a random
+    position in the challenge.
+
+    The first query looks at or after a random value. We may not get a
+    task from it if there is no task with Task.random >= the random
+    value. chance of this gets bigger as the remaining available task
+    number gets smaller, so the second query looks before it. Both are
+    range scans on idx_task_available."""
 
     rn = random()
+    queries = []
+    for position in (Task.random >= rn, Task.random < rn):
+        q = Task.query.filter(Task.challenge_slug == challenge.slug,
+                              Task.is_available,
+                              position).order_by(Task.random)
+        queries.append(refine_with_user_area(q))
+    return queries
+
+
+def get_random_task(challenge, with_geometries=False):
+    """Get a random task, with its geometries loaded in the same query
+    if with_geometries is True"""
 
-    # get a random task. first pass
+    task = dispense_task(challenge, with_geometries=with_geometries)
+    if task is not None:
+        return task
+
+    for q in random_task_queries(challenge):
+        app.logger.debug(compile_query(q))
+        if with_geometries:
+            q = q.options(joinedload(Task.geometries))
+        task = q.first()
+        if task is not None:
+            return task
+    return None
+
+
+def claim_random_task(challenge, osmid=None, with_geometries=False):
+    """Get a random task and assign it to the user in one go.
+
+    This picks from the same random position in the challenge as
+    get_random_task, but hands the candidate query to claim_task so
+    that concurrent requests never receive the same task."""
+
+    task = dispense_task(challenge, claim=True, osmid=osmid,
+                         with_geometries=with_geometries)
+    if task is not None:
+        return task
+
+    for q in random_task_queries(challenge):
+        task = claim_task(q, osmid, with_geometries=with_geometries)
+        if task is not None:
+            return task
+    return None
+
+
+def get_random_tasks(challenge, count, claim=False, osmid=None):
+    """Get up to count random tasks, assigning them to
+    the user if claim is True"""
+
+    tasks = []
+    for q in random_task_queries(challenge):
+        if claim:
+            tasks.extend(claim_tasks(q, osmid, limit=count - len(tasks)))
+        else:
+            tasks.extend(q.limit(count - len(tasks)).all())
+        if len(tasks) >= count:
+            break
+    return tasks
+
+
+def claim_task(query, osmid=None, status='assigned', with_geometries=False):
+    """Atomically assign the first task of a task query.
+
+    Returns the claimed task row, or None if there was nothing
+    to claim. See claim_tasks."""
+
+    tasks = claim_tasks(query, osmid, status,
+                        with_geometries=with_geometries)
+    return tasks[0] if tasks else None
+
+
+def claim_tasks(query, osmid=None, status='assigned', limit=1,
+                with_geometries=False):
+    """Atomically assign the first tasks of a task query.
+
+    This emits a single statement that locks up to limit task rows of
+    the query, skipping rows that are already locked by a concurrent
+    claim, sets their status and records the matching actions. Returns
+    the claimed task rows. With with_geometries, the rows also have the
+    task's geometries, as a list of {'osmid': .., 'geometry': GeoJSON}
+    objects in a 'geometries' column."""
+
+    tasks = Task.__table__
+    actions = Action.__table__
+
+    # the candidate tasks, skipping rows other claims have locked
+    candidates = query.with_entities(Task.id).limit(limit).with_for_update(
+        skip_locked=True)
+    # the location is returned as is and only encoded in the outer select
+    claimed = tasks.update().where(
+        tasks.c.id.in_(candidates.subquery())).values(
+        status=status,
+        assigned_until=lease_expiry(status)).returning(
+        tasks.c.id,
+        tasks.c.identifier,
+        tasks.c.challenge_slug,
+        tasks.c.instruction,
+        tasks.c.status,
+        type_coerce(tasks.c.location, NullType).label('location')).cte(
+        'claimed')
+    # store the timestamp as naive UTC time, like Action does
+    timestamp = datetime.now(pytz.utc).replace(tzinfo=None)
+    logged = actions.insert().from_select(
+        ['timestamp', 'user_id', 'task_id', 'status'],
+        select([literal(timestamp, actions.c.timestamp.type),
+                literal(osmid, actions.c.user_id.type),
+                claimed.c.id,
+                literal(status, actions.c.status.type)])).returning(
+        actions.c.task_id).cte('logged')
+    columns = [
+        claimed.c.id,
+        claimed.c.identifier,
+        claimed.c.challenge_slug,
+        claimed.c.instruction,
+        claimed.c.status,
+        type_coerce(claimed.c.location, Geometry).label('location')]
+    if with_geometries:
+        geometries = TaskGeometry.__table__
+        columns.append(select([func.json_agg(func.json_build_object(
+            'osmid', geometries.c.osmid,
+            'geometry', cast(func.ST_AsGeoJSON(geometries.c.geom), JSON)))]
+        ).where(geometries.c.task_id == claimed.c.id).as_scalar().label(
+            'geometries'))
+    statement = select(columns).select_from(
+        claimed.join(logged, logged.c.task_id == claimed.c.id))
+    try:
+        claimed_tasks = db.session.execute(statement).fetchall()
+        db.session.commit()
+    except Exception as e:
+        app.logger.warn(e)
+        db.session.rollback()
+        raise e
+    return claimed_tasks
+
+
+def nearest_task_query(challenge, lon, lat, max_distance=None):
+    """Return a query for the available tasks of a challenge, nearest
+    to the given lon / lat first.
+
+    The ordering uses the <-> operator, so PostGIS walks the spatial
+    index outward from the point instead of scanning all tasks. Tasks
+    further away than max_distance (in degrees, defaulting to the
+    NEARBUFFER setting) are left out."""
+
+    if max_distance is None:
+        max_distance = app.config["NEARBUFFER"]
+    point = from_shape(Point(lon, lat), srid=4326)
     q = Task.query.filter(Task.challenge_slug == challenge.slug,
-                          Task.status.in_([
-                              'available',
-                              'skipped',
-                              'created']),
-                          Task.random >= rn).order_by(Task.random)
+                          Task.is_available,
+                          ST_DWithin(Task.location, point, max_distance))
     q = refine_with_user_area(q)
-    app.logger.debug(compile_query(q))
-    if q.first() is None:
-        # we may not have gotten one if there is no task with
-        # Task.random <= the random value. chance of this gets
-        # bigger as the remaining available task number gets
-        # smaller
-        q = Task.query.filter(Task.challenge_slug == challenge.slug,
-                              Task.status.in_([
-                                  'available',
-                                  'skipped',
-                                  'created']),
-                              Task.random < rn).order_by(Task.random)
-    q = refine_with_user_area(q)
-    return q.first() or None
+    return q.order_by(Task.location.distance_centroid(point))
+
+
+def set_task_status(challenge_slug, task_identifier, action):
+    """Set the status of a task from an action, and record the action.
+
+    The task status and the action are written in a single statement.
+    If BUFFER_ACTIONS is set, only the task status is written right
+    away, and the action is queued to be inserted in bulk together with
+    the actions of other requests. Returns False if there is no such
+    task."""
+
+    tasks = Task.__table__
+    actions = Action.__table__
+
+    updated = tasks.update().where(and_(
+        tasks.c.challenge_slug == challenge_slug,
+        tasks.c.identifier == task_identifier)).values(
+        status=action.status,
+        assigned_until=lease_expiry(action.status)).returning(tasks.c.id)
+    buffered = app.config.get('BUFFER_ACTIONS', False)
+    if buffered:
+        statement = updated
+    else:
+        updated = updated.cte('updated')
+        logged = actions.insert().from_select(
+            ['timestamp', 'user_id', 'task_id', 'status', 'editor'],
+            select([literal(action.timestamp, actions.c.timestamp.type),
+                    literal(action.user_id, actions.c.user_id.type),
+                    updated.c.id,
+                    literal(action.status, actions.c.status.type),
+                    literal(action.editor, actions.c.editor.type)])).returning(
+            actions.c.task_id).cte('logged')
+        statement = select([logged.c.task_id])
+    try:
+        task_id = db.session.execute(statement).scalar()
+        db.session.commit()
+    except Exception as e:
+        app.logger.warn(e)
+        db.session.rollback()
+        raise e
+    if task_id is None:
+        return False
+    if buffered:
+        get_action_buffer().add(task_id, action)
+    return True
+
+
+def release_stale_tasks():
+    """Make the tasks whose lease has run out available again.
+
+    The tasks are released and their 'available' actions recorded
+    with a single statement. Returns the number of tasks released."""
+
+    tasks = Task.__table__
+    actions = Action.__table__
+
+    # store the timestamp as naive UTC time, like Action does
+    now = datetime.now(pytz.utc).replace(tzinfo=None)
+    released = tasks.update().where(and_(
+        tasks.c.assigned_until < now,
+        tasks.c.status.in_(LEASED_STATUSES))).values(
+        status='available',
+        assigned_until=None).returning(tasks.c.id).cte('released')
+    logged = actions.insert().from_select(
+        ['timestamp', 'task_id', 'status'],
+        select([literal(now, actions.c.timestamp.type),
+                released.c.id,
+                literal('available', actions.c.status.type)])).returning(
+        actions.c.task_id).cte('logged')
+    statement = select([func.count()]).select_from(logged)
+    try:
+        count = db.session.execute(statement).scalar()
+        db.session.commit()
+    except Exception as e:
+        app.logger.warn(e)
+        db.session.rollback()
+        raise e
+    return count
+
+
+# the length of a degree of latitude, and of longitude on the equator
+METERS_PER_DEGREE = 111320.0
+
+
+def get_status_counts(challenge_slug):
+    """Return the number of tasks per status for a challenge, from the
+    counts kept up to date by the triggers on the tasks table"""
+
+    total = func.sum(ChallengeStatusCount.count)
+    return dict(db.session.query(
+        ChallengeStatusCount.status,
+        total).filter(
+        ChallengeStatusCount.challenge_slug == challenge_slug).group_by(
+        ChallengeStatusCount.status).having(total > 0))
+
+
+def repair_status_counts(challenge_slug=None):
+    """Recount the tasks per status, and per grid tile and status, for
+    one challenge, or for all of them. Returns the number of
+    (challenge, status) counts stored."""
+
+    params = {'slug': challenge_slug}
+    where = 'WHERE challenge_slug = :slug' if challenge_slug else ''
+    try:
+        # keep the triggers from changing the counts in the meantime
+        db.session.execute(
+            'LOCK TABLE challenge_status_counts, challenge_tile_counts '
+            'IN EXCLUSIVE MODE')
+        db.session.execute(text(
+            'DELETE FROM challenge_status_counts {where}'.format(
+                where=where)), params)
+        # the recounts all go into the default shard
+        count = db.session.execute(text("""
+            INSERT INTO challenge_status_counts
+                (challenge_slug, status, count)
+            SELECT challenge_slug, COALESCE(status, ''), count(*)
+            FROM tasks {where}
+            GROUP BY 1, 2""".format(where=where)), params).rowcount
+        db.session.execute(text(
+            'DELETE FROM challenge_tile_counts {where}'.format(
+                where=where)), params)
+        db.session.execute(text("""
+            INSERT INTO challenge_tile_counts
+                (challenge_slug, tile_x, tile_y, status, count)
+            SELECT challenge_slug,
+                floor(ST_X(location) / {size})::integer,
+                floor(ST_Y(location) / {size})::integer,
+                COALESCE(status, ''), count(*)
+            FROM tasks WHERE location IS NOT NULL {where}
+            GROUP BY 1, 2, 3, 4""".format(
+            size=TILE_SIZE,
+            where=where.replace('WHERE', 'AND'))), params)
+        db.session.commit()
+    except Exception as e:
+        app.logger.warn(e)
+        db.session.rollback()
+        raise e
+    return count
 
 
 def json_to_task(slug, data, task=None, identifier=None):
@@ -198,14 +568,17 @@ def json_to_task(slug, data, task=None, identifier=None):
     return task
 
 
-def geojson_to_task(slug, feature):
+def geojson_to_task(slug, feature, tasks=None):
     """converts one geojson feature to a task.
     This will only work in a limited number of cases, where:
     * The geometry is one single Point or Linestring feature,
     * The OSM ID of the feature is in the id field of the JSON,
     and you are OK with the following:
     * The description cannot be set at the task level
-    * The identifier will be slug-osmid"""
+    * The identifier will be slug-osmid
+    If tasks, a dictionary of the existing tasks by identifier, is
+    passed in, the existing task is looked up there instead of
+    in the database."""
     # check for id and geometries
     if 'id' not in feature:
         app.logger.debug('no id in this feature, skipping')
@@ -219,9 +592,12 @@ def geojson_to_task(slug, feature):
         slug=slug,
         osmid=osmid)
     # find, or create a task
-    task = Task.query.filter(
-        Task.challenge_slug == slug).filter(
-        Task.identifier == identifier).first()
+    if tasks is not None:
+        task = tasks.get(identifier)
+    else:
+        task = Task.query.filter(
+            Task.challenge_slug == slug).filter(
+            Task.identifier == identifier).first()
     if task is None:
         task = Task(slug, identifier)
         app.logger.debug('creating task {identifier}'.format(
@@ -233,9 +609,9 @@ def geojson_to_task(slug, feature):
         task.geometries = []
     # get the geometry
     geom = feature['geometry']
-    shape = asShape(geom)
     try:
-        g = TaskGeometry(osmid, shape)
+        shape = asShape(geom)
+        g = TaskGeometry(shape, osmid)
         task.geometries.append(g)
         return task
     except Exception as e:
@@ -243,6 +619,83 @@ def geojson_to_task(slug, feature):
         return None
 
 
+def geojson_features(stream):
+    """Iterate over the features of a GeoJSON FeatureCollection
+    read from a file-like object, parsing one feature at a time"""
+
+    for feature in ijson.items(stream, 'features.item'):
+        yield undecimal(feature)
+
+
+def json_tasks(stream):
+    """Iterate over the tasks in a JSON list in the admin API task
+    format read from a file-like object, parsing one task at a time"""
+
+    for task in ijson.items(stream, 'item'):
+        yield undecimal(task)
+
+
+def undecimal(value):
+    """Convert the decimals in parsed JSON to floats. The parser returns
+    every non-integer number as a decimal, which json.dumps rejects."""
+
+    if isinstance(value, dict):
+        return dict((k, undecimal(v)) for k, v in value.items())
+    if isinstance(value, list):
+        return [undecimal(v) for v in value]
+    if isinstance(value, Decimal):
+        return float(value)
+    return value
+
+
+def geojson_to_tasks(slug, features, chunk_size=None):
+    """Create or update tasks from an iterable of GeoJSON features.
+
+    The features are handled in chunks of chunk_size (defaulting to
+    TASKS_CHUNK_SIZE). For each chunk the existing tasks are looked
+    up with one query, and the chunk is committed once, so memory use
+    does not grow with the number of features. Returns the number of
+    tasks created or updated."""
+
+    if chunk_size is None:
+        chunk_size = app.config.get('TASKS_CHUNK_SIZE', 1000)
+    count = 0
+    chunk = []
+    for feature in features:
+        chunk.append(feature)
+        if len(chunk) >= chunk_size:
+            count += geojson_chunk_to_tasks(slug, chunk)
+            chunk = []
+    if chunk:
+        count += geojson_chunk_to_tasks(slug, chunk)
+    return count
+
+
+def geojson_chunk_to_tasks(slug, features):
+    """Create or update and commit the tasks for a list of features"""
+
+    tasks = get_tasks_by_identifier(
+        slug,
+        ['{slug}-{osmid}'.format(slug=slug, osmid=f['id'])
+         for f in features if 'id' in f])
+    count = 0
+    for feature in features:
+        task = geojson_to_task(slug, feature, tasks)
+        if task is not None:
+            db.session.add(task)
+            # a feature may occur more than once
+            tasks[task.identifier] = task
+            count += 1
+    try:
+        db.session.commit()
+    except Exception as e:
+        app.logger.warn(e)
+        db.session.rollback()
+        raise e
+    app.logger.debug('stored {count} tasks from geojson'.format(count=count))
+    return count
+
+
 def get_envelope(geoms):
     """returns the spatial envelope of a list of coordinate pairs
     in the form [(lon, lat), ...]"""
@@ -253,10 +706,28 @@ def user_area_is_defined():
     return 'lon' and 'lat' and 'radius' in session
 
 
+def user_area_bounds(lon, lat, radius):
+    """Return a (minx, miny, maxx, maxy) box in degrees that contains
+    the area within 'radius' meters of lon, lat"""
+    # a degree of latitude is at least 110 km, and a degree of
+    # longitude is the shortest at the poleward edge of the area
+    dlat = radius / 110000.0
+    dlon = radius / (METERS_PER_DEGREE * max(
+        math.cos(math.radians(abs(lat) + dlat)), 0.01))
+    return lon - dlon, lat - dlat, lon + dlon, lat + dlat
+
+
 def refine_with_user_area(query):
     """Takes a query and refines it with a spatial constraint
     based on user setting"""
     if 'lon' and 'lat' and 'radius' in session:
+        minx, miny, maxx, maxy = user_area_bounds(
+            session["lon"], session["lat"], session["radius"])
+        if minx >= -180 and maxx <= 180:
+            # narrow the tasks down to the box around the area first,
+            # which can use the spatial index on the task locations
+            query = query.filter(Task.location.intersects(
+                func.ST_MakeEnvelope(minx, miny, maxx, maxy, 4326)))
         return query.filter(ST_DWithin(
             cast(Task.location, Geography),
             cast(from_shape(Point(session["lon"], session["lat"])), Geography),
@@ -265,6 +736,51 @@ def refine_with_user_area(query):
         return query
 
 
+def area_status_counts(challenge_slug, lon, lat, radius):
+    """Estimate the number of tasks per status for a challenge within
+    'radius' meters of lon, lat from the task counts per grid tile.
+    The tiles that are partly in the area count in proportion to the
+    part of them that is. This takes the same time however many tasks
+    the challenge has."""
+    # the area as an ellipse in degrees
+    area = prep(scale(
+        Point(lon, lat).buffer(1, 16),
+        radius / (METERS_PER_DEGREE * max(math.cos(math.radians(lat)), 0.01)),
+        radius / METERS_PER_DEGREE))
+    minx, miny, maxx, maxy = user_area_bounds(lon, lat, radius)
+    tiles = db.session.query(
+        ChallengeTileCount.tile_x,
+        ChallengeTileCount.tile_y,
+        ChallengeTileCount.status,
+        func.sum(ChallengeTileCount.count)).filter(
+        ChallengeTileCount.challenge_slug == challenge_slug,
+        ChallengeTileCount.tile_x.between(
+            int(math.floor(minx / TILE_SIZE)),
+            int(math.floor(maxx / TILE_SIZE))),
+        ChallengeTileCount.tile_y.between(
+            int(math.floor(miny / TILE_SIZE)),
+            int(math.floor(maxy / TILE_SIZE)))).group_by(
+        ChallengeTileCount.tile_x,
+        ChallengeTileCount.tile_y,
+        ChallengeTileCount.status)
+    weights = {}
+    counts = {}
+    for x, y, status, count in tiles:
+        if (x, y) not in weights:
+            tile = box(x * TILE_SIZE, y * TILE_SIZE,
+                       (x + 1) * TILE_SIZE, (y + 1) * TILE_SIZE)
+            if area.contains(tile):
+                weights[(x, y)] = 1.0
+            elif area.intersects(tile):
+                weights[(x, y)] = \
+                    area.context.intersection(tile).area / tile.area
+            else:
+                weights[(x, y)] = 0.0
+        counts[status] = counts.get(status, 0) + count * weights[(x, y)]
+    return dict((status, int(round(count)))
+                for status, count in counts.items())
+
+
 def send_email(to, subject, text):
     requests.post(
         "https://api.mailgun.net/v2/maproulette.org/messages",
@@ -275,49 +791,119 @@ def send_email(to, subject, text):
               "text": text})
 
 
+# the resolutions of the history statistics, from fine to coarse, with
+# the (longest) span of time of a bucket at each
+RESOLUTIONS = [
+    ('hour', timedelta(hours=1)),
+    ('day', timedelta(days=1)),
+    ('week', timedelta(days=7)),
+    ('month', timedelta(days=31))]
+
+
 # TODO this function is a mess.
-def as_stats_dict(tuples, order=[0, 1, 2], start=None, end=None):
+def as_stats_dict(tuples, order=[0, 1, 2], start=None, end=None,
+                  resolution='day'):
     # this parses three-field statistics query result in the form
     # [('status', datetime(2012, 05, 01, 12, 00), 12), ...]
     # into a dictionary that can easily be parsed by the charting client:
     # [{'key': 'status', values: {'date': value, ...}}, ...]
     # it takes into account the passed-in time slicing parameters and
-    # pads the date range with missing values.
-    result = []
+    # pads the date range with missing values, a value per bucket of
+    # the resolution (hour, day, week or month).
     if len(tuples) == 0:
         return {}
-    for group in sorted(set([t[order[0]] for t in tuples])):
-        data = {}
-        for t in tuples:
-            if t[order[0]] == group:
-                data[t[order[1]]] = t[order[2]]
-        if isinstance(t[order[1]], datetime):
-            start_in_data = min([t[order[1]] for t in tuples])
-            end_in_data = max([t[order[1]] for t in tuples])
-            if start is not None:
-                start = min(start_in_data, start)
-            else:
-                start = start_in_data
-            if end is not None:
-                end = max(end_in_data, end)
-            else:
-                end = end_in_data
-            data = pad_dates(start, end, data)
+    group_index, key_index, value_index = order
+    # group the values in one pass over the tuples
+    groups = {}
+    for t in tuples:
+        groups.setdefault(t[group_index], {})[t[key_index]] = t[value_index]
+    buckets = None
+    if isinstance(tuples[-1][key_index], datetime):
+        keys = [t[key_index] for t in tuples]
+        start = min(keys) if start is None else min(min(keys), start)
+        # up to the end, or to just after the last bucket with a value
+        last = next_bucket(max(keys), resolution)
+        end = last if end is None else max(last, end)
+        # the buckets are the same for all groups
+        buckets = date_buckets(start, end, resolution)
+    result = []
+    for group in sorted(groups):
+        data = groups[group]
+        if buckets is not None:
+            data = pad_dates(data, buckets)
         result.append({
             "key": group,
             "values": data})
     return result
 
 
-def pad_dates(start, end, data):
-    result = {}
-    days = (end - start).days if (end - start).days > 0 else 1
-    for date in (start + timedelta(n) for n in range(days)):
-        if date not in data.keys():
-            result[parse_time(date)] = 0
-        else:
-            result[parse_time(date)] = data[date]
-    return result
+def bucket_start(date, resolution='day'):
+    """Return the start of the bucket of the resolution that date is in,
+    the same as postgres' date_trunc (so weeks start on Monday)"""
+    date = date.replace(minute=0, second=0, microsecond=0)
+    if resolution == 'hour':
+        return date
+    date = date.replace(hour=0)
+    if resolution == 'week':
+        return date - timedelta(days=date.weekday())
+    if resolution == 'month':
+        return date.replace(day=1)
+    return date
+
+
+def period_start(period, date):
+    """Return the start of the leaderboard period that date is in"""
+    if period == 'all':
+        return datetime(1970, 1, 1)
+    return bucket_start(date, period)
+
+
+def next_bucket(date, resolution='day'):
+    """Return the start of the bucket after the one date is in"""
+    date = bucket_start(date, resolution)
+    if resolution == 'month':
+        if date.month == 12:
+            return date.replace(year=date.year + 1, month=1)
+        return date.replace(month=date.month + 1)
+    return date + dict(RESOLUTIONS)[resolution]
+
+
+def date_buckets(start, end, resolution='day'):
+    """Return the starts of the buckets from the one start is in up to
+    end, at least one"""
+    buckets = [bucket_start(start, resolution)]
+    while True:
+        date = next_bucket(buckets[-1], resolution)
+        if date >= end:
+            return buckets
+        buckets.append(date)
+
+
+def pad_dates(data, buckets):
+    """Return the values in data, a dictionary of datetimes, for each of
+    the buckets by ISO date, with 0 for the buckets not in data"""
+    return dict((parse_time(date), data.get(date, 0)) for date in buckets)
+
+
+def choose_resolution(start, end, max_points, earliest_hour=None):
+    """Return the finest resolution that has at most max_points buckets
+    from start up to end, and for which there are metrics from start on
+    (earliest_hour being the start of the hourly ones)"""
+    for resolution, step in RESOLUTIONS:
+        if resolution == 'hour' and earliest_hour is not None and \
+                start < earliest_hour:
+            continue
+        if count_buckets(start, end, resolution) <= max_points:
+            return resolution
+    return RESOLUTIONS[-1][0]
+
+
+def count_buckets(start, end, resolution):
+    """Return (about, for months) the number of buckets of the resolution
+    from start up to end"""
+    span = end - bucket_start(start, resolution)
+    step = dict(RESOLUTIONS)[resolution]
+    return int(span.total_seconds() // step.total_seconds()) + 1
 
 
 # time in seconds from epoch
@@ -0,0 +1,228 @@
+"""Bulk task imports, run in the background by a local worker"""
+
+from maproulette import app, db
+from maproulette.models import ImportJob
+from maproulette.bulkload import TaskLoader
+from maproulette.helpers import json_tasks, geojson_features, \
+    geojson_to_tasks, existing_identifiers
+from datetime import datetime
+from itertools import islice
+import json
+import os
+import pytz
+import shutil
+import socket
+import tempfile
+import time
+
+
+def utcnow():
+    # store timestamps as naive UTC time
+    return datetime.now(pytz.utc).replace(tzinfo=None)
+
+
+def jobs_dir():
+    """Return the directory uploads are spooled to, creating it if needed"""
+
+    path = app.config.get(
+        'IMPORT_JOBS_DIR',
+        os.path.join(tempfile.gettempdir(), 'maproulette-jobs'))
+    try:
+        os.makedirs(path)
+    except OSError:
+        if not os.path.isdir(path):
+            raise
+    return path
+
+
+def enqueue_import(challenge_slug, kind, stream):
+    """Spool an upload read from a file-like object to disk, and queue
+    an import job of the given kind for it. Returns the job."""
+
+    if kind not in importers:
+        raise ValueError('unknown import job kind {}'.format(kind))
+    fd, filename = tempfile.mkstemp(
+        prefix='{slug}-{kind}-'.format(slug=challenge_slug, kind=kind),
+        suffix='.json',
+        dir=jobs_dir())
+    try:
+        with os.fdopen(fd, 'wb') as f:
+            shutil.copyfileobj(stream, f, 1024 * 1024)
+        job = ImportJob(
+            challenge_slug,
+            kind,
+            socket.gethostname(),
+            filename,
+            size=os.path.getsize(filename))
+        db.session.add(job)
+        db.session.commit()
+    except Exception as e:
+        app.logger.warn(e)
+        db.session.rollback()
+        os.remove(filename)
+        raise e
+    app.logger.debug('queued {kind} job {id} for {slug}'.format(
+        kind=kind, id=job.id, slug=challenge_slug))
+    return job
+
+
+def claim_import_job():
+    """Mark the oldest queued job for this host as running and return
+    it, or return None if there are no jobs waiting"""
+
+    job = db.session.query(ImportJob).filter(
+        ImportJob.host == socket.gethostname(),
+        ImportJob.status == 'queued').order_by(
+        ImportJob.id).with_for_update(skip_locked=True).first()
+    if job is not None:
+        job.status = 'running'
+        job.started = utcnow()
+    db.session.commit()
+    return job
+
+
+def fail_interrupted_jobs():
+    """Mark the jobs for this host that were left running (by a worker
+    that was stopped halfway) as failed. Returns the number of jobs."""
+
+    jobs = db.session.query(ImportJob).filter(
+        ImportJob.host == socket.gethostname(),
+        ImportJob.status == 'running').all()
+    for job in jobs:
+        job.status = 'failed'
+        job.finished = utcnow()
+        job.error = 'the import was interrupted'
+        if os.path.exists(job.filename):
+            os.remove(job.filename)
+    db.session.commit()
+    return len(jobs)
+
+
+def run_import_job(job):
+    """Run an import job, and record its outcome on the job"""
+
+    app.logger.info('running {kind} job {id} for {slug}'.format(
+        kind=job.kind, id=job.id, slug=job.challenge_slug))
+    progress = None
+    try:
+        with open(job.filename, 'rb') as f:
+            progress = JobProgress(job.id, f)
+            result = importers[job.kind](job.challenge_slug, f, progress)
+        job.status = 'done'
+        job.result = json.dumps(result)
+        job.bytes_read = job.size
+    except Exception as e:
+        app.logger.warn(e)
+        db.session.rollback()
+        # a failed job keeps the progress it last recorded
+        job.status = 'failed'
+        job.error = u'{}'.format(e)
+    finally:
+        if os.path.exists(job.filename):
+            os.remove(job.filename)
+    if progress is not None:
+        job.rows = progress.rows
+    job.finished = utcnow()
+    db.session.commit()
+    app.logger.info('{kind} job {id} for {slug} {status}'.format(
+        kind=job.kind, id=job.id, slug=job.challenge_slug, status=job.status))
+
+
+class JobProgress(object):
+
+    """Counts the rows an import job has read, and writes the count to
+    the job every 'interval' seconds. The progress is written in its own
+    transaction, so that it can be seen while the import is running."""
+
+    def __init__(self, job_id, stream, interval=2):
+        self.job_id = job_id
+        self.stream = stream
+        self.interval = interval
+        self.rows = 0
+        self.next_update = time.time() + interval
+
+    def track(self, rows):
+        """Iterate over rows, counting them"""
+
+        for row in rows:
+            self.rows += 1
+            if time.time() >= self.next_update:
+                self.update()
+            yield row
+
+    def update(self):
+        with db.engine.begin() as connection:
+            connection.execute(ImportJob.__table__.update().where(
+                ImportJob.id == self.job_id).values(
+                rows=self.rows,
+                bytes_read=self.stream.tell()))
+        self.next_update = time.time() + self.interval
+
+
+def new_tasks(challenge_slug, tasks, chunk_size=1000):
+    """Iterate over the tasks that do not exist yet, looking up the
+    existing tasks one chunk at a time"""
+
+    tasks = iter(tasks)
+    for chunk in iter(lambda: list(islice(tasks, chunk_size)), []):
+        for task in chunk:
+            if not isinstance(task.get('identifier'), basestring):
+                raise ValueError('task identifier must exist and be string')
+        existing = existing_identifiers(
+            challenge_slug, [task['identifier'] for task in chunk])
+        for task in chunk:
+            if task['identifier'] in existing:
+                app.logger.debug("Skipping task ({identifier}) as it already exists.".format(identifier=task['identifier']))
+                continue
+            if 'geometries' not in task:
+                raise ValueError('new task must have geometries')
+            yield task
+
+
+def create_tasks(challenge_slug, f, progress):
+    """Create the tasks in a JSON list that do not exist yet"""
+
+    loader = TaskLoader(challenge_slug)
+    loader.add_json_many(
+        new_tasks(challenge_slug, progress.track(json_tasks(f))),
+        processes=app.config.get('BULK_LOAD_PROCESSES'))
+    return loader.load()
+
+
+def update_tasks(challenge_slug, f, progress):
+    """Create or update the tasks in a JSON list"""
+
+    loader = TaskLoader(challenge_slug)
+    loader.add_json_many(progress.track(json_tasks(f)),
+                         processes=app.config.get('BULK_LOAD_PROCESSES'))
+    return loader.load()
+
+
+def sync_tasks(challenge_slug, f, progress):
+    """Make the tasks of a challenge match the full list in a JSON
+    list, marking the tasks that are not in it as deleted"""
+
+    loader = TaskLoader(challenge_slug)
+    loader.add_json_many(progress.track(json_tasks(f)),
+                         processes=app.config.get('BULK_LOAD_PROCESSES'))
+    return loader.sync()
+
+
+def store_features(challenge_slug, f, progress):
+    """Create or update tasks from GeoJSON features"""
+
+    count = geojson_to_tasks(
+        challenge_slug, progress.track(geojson_features(f)))
+    # if there are no features, bail
+    if not count:
+        raise ValueError('no features in geoJSON')
+    return {'stored': count}
+
+
+# the import job kinds, and the functions that run them
+importers = {
+    'create': create_tasks,
+    'update': update_tasks,
+    'load': update_tasks,
+    'sync': sync_tasks,
+    'geojson': store_features}
@@ -0,0 +1,255 @@
+"""Incremental materialization of the metrics tables from the actions"""
+
+from maproulette import app, db
+from maproulette.models import MetricsState, COMPLETED_STATUSES
+from sqlalchemy import text
+from datetime import datetime, timedelta
+import pytz
+
+
+# take the first :batch_size actions off the queue (see MetricsQueue)
+# into the batch of actions to count. An action is only queued when it
+# commits, so actions that commit late are counted all the same.
+TAKE_BATCH = """
+CREATE TEMPORARY TABLE metrics_batch (action_id integer PRIMARY KEY)
+    ON COMMIT DROP;
+WITH taken AS (
+    DELETE FROM metrics_queue WHERE action_id IN (
+        SELECT action_id FROM metrics_queue
+        ORDER BY action_id LIMIT :batch_size)
+    RETURNING action_id
+)
+INSERT INTO metrics_batch SELECT action_id FROM taken;
+"""
+
+# empty the queue and take all actions into the batch, in one statement
+# so that every action is either in the batch or left in the queue
+TAKE_ALL = """
+CREATE TEMPORARY TABLE metrics_batch (action_id integer PRIMARY KEY)
+    ON COMMIT DROP;
+WITH cleared AS (
+    DELETE FROM metrics_queue
+)
+INSERT INTO metrics_batch SELECT id FROM actions;
+"""
+
+BATCH_SIZE = """
+SELECT count(*), max(action_id) FROM metrics_batch
+"""
+
+# add the actions in the batch to the daily counts, to the hourly
+# (from :hour_cutoff on), weekly and monthly rollups, and to the scores
+# on the leaderboards. The actions are counted by hour once, and the
+# other counts are summed from those.
+UPDATE_HISTORICAL = """
+WITH hours AS (
+    SELECT date_trunc('hour', a.timestamp) AS hour,
+        COALESCE(a.user_id, 0) AS user_id,
+        COALESCE(max(u.display_name), '') AS user_name,
+        t.challenge_slug,
+        a.status,
+        count(a.id) AS count
+    FROM actions a
+        JOIN tasks t ON t.id = a.task_id
+        JOIN metrics_batch b ON b.action_id = a.id
+        LEFT OUTER JOIN users u ON u.id = a.user_id
+    GROUP BY hour, COALESCE(a.user_id, 0), t.challenge_slug, a.status
+), days AS (
+    INSERT INTO metrics_historical
+        (timestamp, user_id, user_name, challenge_slug, status, count)
+    SELECT date_trunc('day', hour) AS day, user_id, max(user_name),
+        challenge_slug, status, sum(count)
+    FROM hours
+    GROUP BY day, user_id, challenge_slug, status
+    ON CONFLICT (timestamp, user_id, challenge_slug, status) DO UPDATE SET
+        count = metrics_historical.count + EXCLUDED.count,
+        user_name = EXCLUDED.user_name
+), leaders AS (
+    INSERT INTO leaderboard_scores
+        (period, period_start, challenge_slug, user_id, user_name, score)
+    SELECT p.period,
+        CASE WHEN p.period = 'all' THEN timestamp '1970-01-01'
+            ELSE date_trunc(p.period, h.hour) END AS period_start,
+        c.challenge_slug, h.user_id, max(h.user_name), sum(h.count)
+    FROM hours h
+        CROSS JOIN (VALUES ('all'), ('month'), ('week'), ('day'))
+            AS p (period)
+        CROSS JOIN LATERAL (VALUES (h.challenge_slug), (''))
+            AS c (challenge_slug)
+    WHERE h.user_id != 0 AND h.status IN :completed
+    GROUP BY p.period, period_start, c.challenge_slug, h.user_id
+    ON CONFLICT (period, period_start, challenge_slug, user_id)
+    DO UPDATE SET
+        score = leaderboard_scores.score + EXCLUDED.score,
+        user_name = EXCLUDED.user_name
+)
+INSERT INTO metrics_rollups
+    (resolution, timestamp, user_id, user_name, challenge_slug, status,
+     count)
+SELECT 'hour', hour, user_id, user_name, challenge_slug, status, count
+FROM hours
+WHERE hour >= :hour_cutoff
+UNION ALL
+SELECT r.resolution, date_trunc(r.resolution, h.hour) AS bucket, h.user_id,
+    max(h.user_name), h.challenge_slug, h.status, sum(h.count)
+FROM hours h CROSS JOIN (VALUES ('week'), ('month')) AS r (resolution)
+GROUP BY r.resolution, bucket, h.user_id, h.challenge_slug, h.status
+ON CONFLICT (resolution, timestamp, user_id, challenge_slug, status)
+DO UPDATE SET
+    count = metrics_rollups.count + EXCLUDED.count,
+    user_name = EXCLUDED.user_name
+"""
+
+# the hourly rollups are only kept for the last METRICS_HOURLY_DAYS days
+PRUNE_HOURLY = """
+DELETE FROM metrics_rollups
+WHERE resolution = 'hour' AND timestamp < :hour_cutoff
+"""
+
+# the aggregate metrics count the tasks by their latest action. For the
+# tasks with actions in the batch, take the task away from the counts of
+# its latest action that was counted before, and add it to the counts of
+# its latest action counted now. The counted actions are the ones that
+# are not queued; those still queued are left for a later batch.
+UPDATE_AGGREGATE = """
+WITH counted AS (
+    SELECT a.id, a.task_id, a.user_id, a.status
+    FROM actions a
+    WHERE a.task_id IN (
+        SELECT ba.task_id FROM actions ba
+            JOIN metrics_batch b ON b.action_id = ba.id)
+        AND NOT EXISTS (
+            SELECT 1 FROM metrics_queue q WHERE q.action_id = a.id)
+), latest AS (
+    SELECT DISTINCT ON (c.task_id) c.task_id, c.user_id, c.status
+    FROM counted c
+    ORDER BY c.task_id, c.id DESC
+), previous AS (
+    SELECT DISTINCT ON (c.task_id) c.task_id, c.user_id, c.status
+    FROM counted c
+    WHERE NOT EXISTS (
+        SELECT 1 FROM metrics_batch b WHERE b.action_id = c.id)
+    ORDER BY c.task_id, c.id DESC
+), deltas AS (
+    SELECT task_id, user_id, status, 1 AS n FROM latest
+    UNION ALL
+    SELECT task_id, user_id, status, -1 AS n FROM previous
+)
+INSERT INTO metrics_aggregate
+    (user_id, user_name, challenge_slug, status, count)
+SELECT COALESCE(d.user_id, 0),
+    COALESCE(max(u.display_name), ''),
+    t.challenge_slug,
+    d.status,
+    sum(d.n)
+FROM deltas d
+    JOIN tasks t ON t.id = d.task_id
+    LEFT OUTER JOIN users u ON u.id = d.user_id
+GROUP BY COALESCE(d.user_id, 0), t.challenge_slug, d.status
+HAVING sum(d.n) != 0
+ON CONFLICT (user_id, challenge_slug, status) DO UPDATE SET
+    count = metrics_aggregate.count + EXCLUDED.count,
+    user_name = EXCLUDED.user_name;
+DELETE FROM metrics_aggregate WHERE count <= 0;
+"""
+
+CLEAR_METRICS = """
+DELETE FROM metrics_historical;
+DELETE FROM metrics_rollups;
+DELETE FROM leaderboard_scores;
+DELETE FROM metrics_aggregate;
+"""
+
+
+def utcnow():
+    # store timestamps as naive UTC time
+    return datetime.now(pytz.utc).replace(tzinfo=None)
+
+
+def hourly_cutoff():
+    """Return the time from which the hourly rollups are kept"""
+
+    return utcnow() - timedelta(
+        days=app.config.get('METRICS_HOURLY_DAYS', 14))
+
+
+def lock_metrics_state(name='actions'):
+    """Return the metrics state, locked until the end of the transaction
+    so that two updates can not count the same actions"""
+
+    db.session.execute(text(
+        "INSERT INTO metrics_state (name, last_action_id) "
+        "VALUES (:name, 0) ON CONFLICT DO NOTHING"), {'name': name})
+    return db.session.query(MetricsState).filter_by(
+        name=name).with_for_update().one()
+
+
+def count_actions(state, take, params=None):
+    """Count the actions taken off the queue by the 'take' statement in
+    the metrics tables. Returns the number of actions."""
+
+    db.session.execute(text(take), params or {})
+    count, last_id = db.session.execute(text(BATCH_SIZE)).first()
+    if not count:
+        return 0
+    db.session.execute(text(UPDATE_HISTORICAL), {
+        'hour_cutoff': hourly_cutoff(),
+        'completed': tuple(COMPLETED_STATUSES)})
+    db.session.execute(text(UPDATE_AGGREGATE))
+    state.last_action_id = max(state.last_action_id, last_id)
+    state.updated = utcnow()
+    return count
+
+
+def update_metrics(batch_size=None):
+    """Update the metrics tables with the actions since the last update,
+    committing every batch_size (defaulting to METRICS_BATCH_SIZE)
+    actions. Returns the number of actions counted."""
+
+    if batch_size is None:
+        batch_size = app.config.get('METRICS_BATCH_SIZE', 100000)
+    counter = 0
+    while True:
+        try:
+            state = lock_metrics_state()
+            count = count_actions(
+                state, TAKE_BATCH, {'batch_size': batch_size})
+            if not count:
+                db.session.execute(text(PRUNE_HOURLY), {
+                    'hour_cutoff': hourly_cutoff()})
+            db.session.commit()
+        except Exception as e:
+            app.logger.warn(e)
+            db.session.rollback()
+            raise e
+        counter += count
+        if not count:
+            return counter
+
+
+def rebuild_metrics():
+    """Rebuild the metrics tables from all actions, in one transaction.
+    Returns the number of actions counted."""
+
+    try:
+        state = lock_metrics_state()
+        db.session.execute(text(CLEAR_METRICS))
+        state.last_action_id = 0
+        state.updated = utcnow()
+        count = count_actions(state, TAKE_ALL)
+        db.session.commit()
+    except Exception as e:
+        app.logger.warn(e)
+        db.session.rollback()
+        raise e
+    return count
+
+
+def metrics_version():
+    """Return how far the metrics tables have been updated. This changes
+    whenever they are, so it can tell when cached statistics are stale."""
+
+    return tuple(db.session.query(
+        MetricsState.last_action_id,
+        MetricsState.updated).filter(
+        MetricsState.name == 'actions').first() or ())
@@ -2,11 +2,12 @@
 
 from sqlalchemy.orm import synonym
 from sqlalchemy.ext.hybrid import hybrid_property, hybrid_method
-from sqlalchemy.schema import Sequence
+from sqlalchemy.schema import Sequence, DDL
+from sqlalchemy import event
 from geoalchemy2.types import Geometry
 from geoalchemy2.shape import from_shape, to_shape
 import random
-from datetime import datetime
+from datetime import datetime, timedelta
 from maproulette import app, db
 from shapely.geometry import Polygon, Point, MultiPoint
 import pytz
@@ -21,10 +22,55 @@ world_polygon = Polygon([
     (-180, -90)])
 
 
+# the task statuses that make a task available for mappers. Queries
+# for available tasks should use Task.is_available, so that they
+# match the predicate of the idx_task_available partial index.
+AVAILABLE_STATUSES = ['available', 'skipped', 'created']
+
+
+# the task statuses for which a task is leased to a mapper. When the
+# lease runs out (see Task.assigned_until), the task is made available
+# again by the stale task reaper.
+LEASED_STATUSES = ['assigned', 'editing']
+
+
+# the task statuses a mapper finishes a task with. Each action that sets
+# one of these scores a point on the leaderboards.
+COMPLETED_STATUSES = ['fixed', 'alreadyfixed', 'falsepositive']
+
+
+# the periods the leaderboards are kept for. Besides the one for all
+# time, there is a leaderboard for each calendar month, week and day.
+LEADERBOARD_PERIODS = ['all', 'month', 'week', 'day']
+
+
 def getrandom():
     return random.random()
 
 
+def lease_expiry(status):
+    """Return the time until which a task with the given status is
+    leased to a mapper, or None if the status does not lease the task"""
+    if status not in LEASED_STATUSES:
+        return None
+    # store the timestamp as naive UTC time
+    return datetime.now(pytz.utc).replace(tzinfo=None) + timedelta(
+        seconds=app.config.get('TASK_LEASE_SECONDS', 3600))
+
+
+def representative_point(shapes):
+    """Return a cheaply calculated representative point for a list of
+    Shapely geometries, or None if there are no coordinates."""
+    # first, get all individual coordinates for the geometries
+    coordinates = []
+    for shape in shapes:
+        coordinates.extend(list(shape.coords))
+    # then, get a representative point (cheaper than centroid)
+    if len(coordinates) > 0:
+        return MultiPoint(coordinates).representative_point()
+    return None
+
+
 class User(db.Model):
 
     """A MapRoulette User"""
@@ -238,12 +284,24 @@ class Task(db.Model):
         db.String)
     instruction = db.Column(
         db.String)
+    assigned_until = db.Column(
+        db.DateTime)
+    content_hash = db.Column(
+        db.String(32))
     # note that spatial indexes seem to be created automagically
     __table_args__ = (
-        db.Index('idx_id', id),
         db.Index('idx_identifer', identifier),
         db.Index('idx_challenge', challenge_slug),
-        db.Index('idx_random', random))
+        db.Index('idx_random', random),
+        # only covers the tasks that can still be handed out, so it
+        # stays small however many tasks a challenge has finished
+        db.Index('idx_task_available',
+                 challenge_slug,
+                 random,
+                 postgresql_where=status.in_(AVAILABLE_STATUSES)),
+        db.Index('idx_task_assigned_until',
+                 assigned_until,
+                 postgresql_where=assigned_until.isnot(None)))
 
     # geometries should always be provided for new tasks, defaulting to None so
     # we can handle task updates and two step initialization of tasks
@@ -278,6 +336,14 @@ class Task(db.Model):
             statuses = [statuses]
         return cls.status.in_(statuses)
 
+    @hybrid_property
+    def is_available(self):
+        return self.status in AVAILABLE_STATUSES
+
+    @is_available.expression
+    def is_available(cls):
+        return cls.status.in_(AVAILABLE_STATUSES)
+
     def update(self, new_values, geometries, commit=True):
         """This updates a task based on a dict with new values"""
         for k, v in new_values.items():
@@ -310,31 +376,110 @@ class Task(db.Model):
     def is_within(self, lon, lat, radius):
         return self.location.intersects(Point(lon, lat).buffer(radius))
 
-    def append_action(self, action):
+    def append_action(self, action, commit=False):
+        """Append an action to this task and set the task status.
+        The action and the status are written together when the session
+        is committed, unless commit is True, in which case that is done
+        right away."""
         self.actions.append(action)
         # duplicate the action status string in the tasks table to save lookups
         self.status = action.status
-        try:
-            db.session.commit()
-        except Exception as e:
-            app.logger.warn(e)
-            db.session.rollback()
-            raise e
+        self.assigned_until = lease_expiry(action.status)
+        if commit:
+            try:
+                db.session.commit()
+            except Exception as e:
+                app.logger.warn(e)
+                db.session.rollback()
+                raise e
 
     def set_location(self):
         """Set the location of a task as a cheaply calculated
         representative point of the combined geometries."""
         # set the location field, which is a representative point
         # for the task's geometries
-        # first, get all individual coordinates for the geometries
-        coordinates = []
-        for geometry in self.geometries:
-            coordinates.extend(list(to_shape(geometry.geom).coords))
-        # then, set the location to a representative point
-        # (cheaper than centroid)
-        if len(coordinates) > 0:
-            self.location = from_shape(MultiPoint(
-                coordinates).representative_point(), srid=4326)
+        point = representative_point(
+            [to_shape(geometry.geom) for geometry in self.geometries])
+        if point is not None:
+            self.location = from_shape(point, srid=4326)
+
+
+# the size in degrees of the grid tiles that task counts are kept for
+# (see ChallengeTileCount). Changing this needs the tile counts to be
+# rebuilt with manage.py repair_status_counts.
+TILE_SIZE = 0.1
+
+# the number of rows each task count is spread over (see
+# ChallengeStatusCount). Each database session adds to one of them, so
+# concurrent status changes in a challenge don't wait on the same row.
+COUNT_SHARDS = 16
+
+# keeps challenge_status_counts and challenge_tile_counts up to date with
+# every insert, update and delete of tasks, in the same transaction. The
+# triggers run once per statement, so a bulk load adjusts each count once,
+# in the shard of the session making the change.
+# Needs PostgreSQL 10 or later, for the transition tables.
+task_status_counts_triggers = DDL("""
+CREATE OR REPLACE FUNCTION count_task_statuses() RETURNS trigger AS $$
+DECLARE
+    deltas text;
+BEGIN
+    -- the change in counts, per task
+    IF TG_OP = 'INSERT' THEN
+        deltas := 'SELECT *, 1 AS n FROM new_tasks';
+    ELSIF TG_OP = 'UPDATE' THEN
+        deltas := 'SELECT *, -1 AS n FROM old_tasks
+                   UNION ALL SELECT *, 1 FROM new_tasks';
+    ELSE
+        deltas := 'SELECT *, -1 AS n FROM old_tasks';
+    END IF;
+    deltas := 'WITH deltas AS (
+        SELECT challenge_slug, COALESCE(status, '''') AS status,
+            floor(ST_X(location) / TILE_SIZE)::integer AS tile_x,
+            floor(ST_Y(location) / TILE_SIZE)::integer AS tile_y,
+            pg_backend_pid() %% COUNT_SHARDS AS shard, n
+        FROM (' || deltas || ') t) ';
+    EXECUTE deltas || ', statuses AS (
+        INSERT INTO challenge_status_counts
+            (challenge_slug, status, shard, count)
+        SELECT challenge_slug, status, shard, sum(n) FROM deltas
+        GROUP BY 1, 2, 3 HAVING sum(n) != 0 ORDER BY 1, 2, 3
+        ON CONFLICT (challenge_slug, status, shard) DO UPDATE
+        SET count = challenge_status_counts.count + EXCLUDED.count)
+    INSERT INTO challenge_tile_counts
+        (challenge_slug, tile_x, tile_y, status, shard, count)
+    SELECT challenge_slug, tile_x, tile_y, status, shard, sum(n) FROM deltas
+    WHERE tile_x IS NOT NULL
+    GROUP BY 1, 2, 3, 4, 5 HAVING sum(n) != 0 ORDER BY 1, 2, 3, 4, 5
+    ON CONFLICT (challenge_slug, tile_x, tile_y, status, shard) DO UPDATE
+    SET count = challenge_tile_counts.count + EXCLUDED.count';
+    -- drop this shard's counts that went down to zero. A shard can go
+    -- below zero when a task is counted in another one; only the sum
+    -- over the shards is the number of tasks.
+    EXECUTE deltas || ', statuses AS (
+        DELETE FROM challenge_status_counts c USING deltas d
+        WHERE c.challenge_slug = d.challenge_slug AND c.status = d.status
+            AND c.shard = d.shard AND c.count = 0)
+    DELETE FROM challenge_tile_counts c USING deltas d
+    WHERE c.challenge_slug = d.challenge_slug
+        AND c.tile_x = d.tile_x AND c.tile_y = d.tile_y
+        AND c.status = d.status AND c.shard = d.shard AND c.count = 0';
+    RETURN NULL;
+END;
+$$ LANGUAGE plpgsql;
+CREATE TRIGGER tasks_status_counts_insert AFTER INSERT ON tasks
+    REFERENCING NEW TABLE AS new_tasks
+    FOR EACH STATEMENT EXECUTE PROCEDURE count_task_statuses();
+CREATE TRIGGER tasks_status_counts_update AFTER UPDATE ON tasks
+    REFERENCING OLD TABLE AS old_tasks NEW TABLE AS new_tasks
+    FOR EACH STATEMENT EXECUTE PROCEDURE count_task_statuses();
+CREATE TRIGGER tasks_status_counts_delete AFTER DELETE ON tasks
+    REFERENCING OLD TABLE AS old_tasks
+    FOR EACH STATEMENT EXECUTE PROCEDURE count_task_statuses();
+""".replace('TILE_SIZE', repr(TILE_SIZE)).replace(
+    'COUNT_SHARDS', repr(COUNT_SHARDS)))
+
+event.listen(Task.__table__, 'after_create', task_status_counts_triggers)
 
 
 class TaskGeometry(db.Model):
@@ -361,6 +506,9 @@ class TaskGeometry(db.Model):
         Geometry,
         nullable=False)
 
+    __table_args__ = (
+        db.Index('idx_task_geometries_taskid', task_id),)
+
     def __init__(self, shape, osmid=None):
         self.osmid = osmid
         self.geom = from_shape(shape)
@@ -434,6 +582,24 @@ class Action(db.Model):
             self.editor = editor
 
 
+# queues every new action for the metrics (see MetricsQueue), in the
+# transaction that inserts it. The trigger runs once per statement, and
+# needs PostgreSQL 10 or later, for the transition table.
+metrics_queue_trigger = DDL("""
+CREATE OR REPLACE FUNCTION queue_actions() RETURNS trigger AS $$
+BEGIN
+    INSERT INTO metrics_queue (action_id) SELECT id FROM new_actions;
+    RETURN NULL;
+END;
+$$ LANGUAGE plpgsql;
+CREATE TRIGGER actions_metrics_queue AFTER INSERT ON actions
+    REFERENCING NEW TABLE AS new_actions
+    FOR EACH STATEMENT EXECUTE PROCEDURE queue_actions();
+""")
+
+event.listen(Action.__table__, 'after_create', metrics_queue_trigger)
+
+
 class HistoricalMetrics(db.Model):
 
     """Holds daily metrics per challenge, user, status, day"""
@@ -458,10 +624,14 @@ class HistoricalMetrics(db.Model):
     count = db.Column(
         db.Integer)
 
+    # the history for a challenge or a user is sliced by time, so
+    # these indexes lead with the challenge or user, then the time.
+    # The history overall uses the primary key, which leads with the time.
     __table_args__ = (
-        db.Index('idx_metrics_userid', user_id),
+        db.Index('idx_metrics_userid_timestamp', user_id, timestamp),
         db.Index('idx_metrics_username', user_name),
-        db.Index('idx_metrics_challengeslug', challenge_slug),
+        db.Index('idx_metrics_challengeslug_timestamp',
+                 challenge_slug, timestamp),
         db.Index('idx_metrics_status', status))
 
     def __init__(self, timestamp, user_id, challenge_slug, status, count):
@@ -472,6 +642,75 @@ class HistoricalMetrics(db.Model):
         self.count = count
 
 
+class MetricsRollup(db.Model):
+
+    """Holds hourly, weekly and monthly metrics per challenge, user and
+    status, for history charts over shorter or longer spans of time than
+    the daily metrics in HistoricalMetrics suit"""
+
+    __tablename__ = 'metrics_rollups'
+
+    resolution = db.Column(
+        db.String,
+        primary_key=True)
+    timestamp = db.Column(
+        db.DateTime,
+        primary_key=True,
+        nullable=False)
+    user_id = db.Column(
+        db.Integer,
+        primary_key=True)
+    user_name = db.Column(
+        db.String)
+    challenge_slug = db.Column(
+        db.String,
+        primary_key=True)
+    status = db.Column(
+        db.String,
+        primary_key=True)
+    count = db.Column(
+        db.Integer)
+
+    __table_args__ = (
+        db.Index('idx_metrics_rollups_userid_timestamp',
+                 resolution, user_id, timestamp),
+        db.Index('idx_metrics_rollups_challengeslug_timestamp',
+                 resolution, challenge_slug, timestamp))
+
+
+class LeaderboardScore(db.Model):
+
+    """Holds the score of each user per leaderboard: for all challenges
+    (with an empty challenge_slug) or for one, over all time or for the
+    period (a month, week or day) starting at period_start"""
+
+    __tablename__ = 'leaderboard_scores'
+
+    period = db.Column(
+        db.String,
+        primary_key=True)
+    period_start = db.Column(
+        db.DateTime,
+        primary_key=True)
+    challenge_slug = db.Column(
+        db.String,
+        primary_key=True)
+    user_id = db.Column(
+        db.Integer,
+        primary_key=True)
+    user_name = db.Column(
+        db.String)
+    score = db.Column(
+        db.Integer,
+        nullable=False)
+
+    # a page of a leaderboard is a range scan of this index
+    __table_args__ = (
+        db.Index('idx_leaderboard_scores_rank',
+                 period, period_start, challenge_slug, score.desc(),
+                 user_id),)
+
+
 class AggregateMetrics(db.Model):
 
     """Holds the aggregate metrics for each challenge and user"""
@@ -494,3 +733,173 @@ class AggregateMetrics(db.Model):
     __table_args__ = (
         db.Index('idx_metrics_agg_username', user_name),
     )
+
+
+class ChallengeStatusCount(db.Model):
+
+    """The number of tasks per challenge and status. This is kept up to
+    date by triggers on the tasks table (task_status_counts_triggers).
+    Each count is spread over up to COUNT_SHARDS rows, one per shard,
+    which are summed when read."""
+
+    __tablename__ = 'challenge_status_counts'
+
+    challenge_slug = db.Column(
+        db.String,
+        primary_key=True)
+    status = db.Column(
+        db.String,
+        primary_key=True)
+    shard = db.Column(
+        db.SmallInteger,
+        primary_key=True,
+        autoincrement=False,
+        server_default='0')
+    count = db.Column(
+        db.Integer,
+        default=0,
+        nullable=False)
+
+
+class ChallengeTileCount(db.Model):
+
+    """The number of tasks per challenge, grid tile and status, for
+    estimating the number of tasks in an area. Tile (x, y) covers the
+    longitudes from x * TILE_SIZE up to (x + 1) * TILE_SIZE, and the
+    latitudes likewise. This is kept up to date by triggers on the
+    tasks table (task_status_counts_triggers), sharded like
+    ChallengeStatusCount."""
+
+    __tablename__ = 'challenge_tile_counts'
+
+    challenge_slug = db.Column(
+        db.String,
+        primary_key=True)
+    tile_x = db.Column(
+        db.Integer,
+        primary_key=True,
+        autoincrement=False)
+    tile_y = db.Column(
+        db.Integer,
+        primary_key=True,
+        autoincrement=False)
+    status = db.Column(
+        db.String,
+        primary_key=True)
+    shard = db.Column(
+        db.SmallInteger,
+        primary_key=True,
+        autoincrement=False,
+        server_default='0')
+    count = db.Column(
+        db.Integer,
+        default=0,
+        nullable=False)
+
+
+class MetricsState(db.Model):
+
+    """How far the metrics tables have been updated: the highest id of
+    the actions counted in them, and when that was"""
+
+    __tablename__ = 'metrics_state'
+
+    name = db.Column(
+        db.String,
+        primary_key=True)
+    last_action_id = db.Column(
+        db.Integer,
+        default=0,
+        nullable=False)
+    updated = db.Column(
+        db.DateTime)
+
+
+class MetricsQueue(db.Model):
+
+    """The ids of the actions that have not been counted in the metrics
+    tables yet. The actions are queued by a trigger (metrics_queue_trigger),
+    so an action is queued when, and only when, it commits."""
+
+    __tablename__ = 'metrics_queue'
+
+    action_id = db.Column(
+        db.Integer,
+        primary_key=True,
+        autoincrement=False)
+
+
+class ImportJob(db.Model):
+
+    """A bulk task import, spooled to disk by the admin API
+    and run in the background by the import worker"""
+
+    __tablename__ = 'import_jobs'
+
+    id = db.Column(
+        db.Integer,
+        unique=True,
+        primary_key=True,
+        nullable=False,
+        autoincrement=True)
+    challenge_slug = db.Column(
+        db.String,
+        db.ForeignKey(
+            'challenges.slug',
+            onupdate="cascade",
+            ondelete="cascade"),
+        nullable=False)
+    kind = db.Column(
+        db.String,
+        nullable=False)
+    status = db.Column(
+        db.String,
+        default='queued',
+        nullable=False)
+    # the spooled upload only exists on the host that received it,
+    # so the job has to run on that host too
+    host = db.Column(
+        db.String,
+        nullable=False)
+    filename = db.Column(
+        db.String,
+        nullable=False)
+    size = db.Column(
+        db.BigInteger,
+        default=0)
+    bytes_read = db.Column(
+        db.BigInteger,
+        default=0)
+    rows = db.Column(
+        db.Integer,
+        default=0)
+    created = db.Column(
+        db.DateTime,
+        nullable=False)
+    started = db.Column(
+        db.DateTime)
+    finished = db.Column(
+        db.DateTime)
+    result = db.Column(
+        db.String)
+    error = db.Column(
+        db.String)
+
+    __table_args__ = (
+        db.Index('idx_import_job_host_status', host, status),)
+
+    def __repr__(self):
+        return "<ImportJob %s %s for %s>" % (
+            self.id, self.status, self.challenge_slug)
+
+    def __init__(self, challenge_slug, kind, host, filename, size=0):
+        self.challenge_slug = challenge_slug
+        self.kind = kind
+        self.host = host
+        self.filename = filename
+        self.size = size
+        self.status = 'queued'
+        self.rows = 0
+        self.bytes_read = 0
+        # store the timestamp as naive UTC time
+        self.created = datetime.now(pytz.utc).replace(tzinfo=None)
@@ -0,0 +1,118 @@
+"""A response cache for the statistics endpoints"""
+
+from maproulette import app
+from maproulette.metrics import metrics_version
+from flask import request
+from collections import OrderedDict
+from functools import wraps
+from threading import Lock
+import time
+
+
+stats_cache = None
+stats_cache_lock = Lock()
+
+
+def get_stats_cache():
+    """Return the statistics cache for this process, creating it if needed"""
+
+    global stats_cache
+    with stats_cache_lock:
+        if stats_cache is None:
+            stats_cache = ResponseCache(
+                ttl=app.config.get('STATS_CACHE_TTL', 300),
+                max_size=app.config.get('STATS_CACHE_SIZE', 1000),
+                check_interval=app.config.get(
+                    'STATS_CACHE_CHECK_INTERVAL', 5),
+                version=metrics_version)
+        return stats_cache
+
+
+def cached_stats(f):
+    """Cache the responses of a statistics endpoint, by request path
+    (so route and path parameters) and query parameters"""
+
+    @wraps(f)
+    def decorator(*args, **kwargs):
+        cache = get_stats_cache()
+        key = (request.path, tuple(sorted(request.args.items())))
+        result = cache.get(key)
+        if result is None:
+            result = f(*args, **kwargs)
+            cache.set(key, result)
+        return result
+    return decorator
+
+
+class ResponseCache(object):
+
+    """A size bounded LRU cache whose entries expire after 'ttl' seconds.
+
+    The cache is also emptied whenever 'version' returns something new,
+    so that it does not serve responses from before the data changed.
+    To keep a cache hit from costing a database query, the version is
+    checked at most once every 'check_interval' seconds."""
+
+    def __init__(self, ttl=300, max_size=1000, check_interval=5,
+                 version=None):
+        self.ttl = ttl
+        self.max_size = max_size
+        self.check_interval = check_interval
+        self.version = version
+        self.current_version = None
+        self.next_check = 0
+        self.entries = OrderedDict()
+        self.lock = Lock()
+        self.hits = 0
+        self.misses = 0
+
+    def check_version(self, now):
+        if self.version is None or now < self.next_check:
+            return
+        version = self.version()
+        with self.lock:
+            if version != self.current_version:
+                self.entries.clear()
+                self.current_version = version
+            self.next_check = now + self.check_interval
+
+    def get(self, key):
+        """Return the cached value for key, or None"""
+
+        now = time.time()
+        self.check_version(now)
+        with self.lock:
+            entry = self.entries.pop(key, None)
+            if entry is None or entry[0] < now:
+                self.misses += 1
+                return None
+            # put the entry back as the most recently used
+            self.entries[key] = entry
+            self.hits += 1
+            return entry[1]
+
+    def set(self, key, value):
+        """Cache a value for key, evicting the least recently used
+        entries if the cache is full"""
+
+        if self.ttl <= 0:
+            return
+        with self.lock:
+            self.entries.pop(key, None)
+            self.entries[key] = (time.time() + self.ttl, value)
+            while len(self.entries) > self.max_size:
+                self.entries.popitem(last=False)
+
+    def clear(self):
+        with self.lock:
+            self.entries.clear()
+
+    def stats(self):
+        """Return the hit and miss counters and the size of the cache"""
+
+        with self.lock:
+            return {
+                'hits': self.hits,
+                'misses': self.misses,
+                'size': len(self.entries),
+                'version': self.current_version}
@@ -0,0 +1,269 @@
+"""Generates synthetic test data in bulk, for development and benchmarking"""
+
+from maproulette import app, db
+from maproulette.models import Challenge, LEASED_STATUSES
+from maproulette.bulkload import copy_row
+from shapely.geometry import box
+from bisect import bisect
+from datetime import datetime, timedelta
+import random
+import tempfile
+
+
+# the final statuses of the generated tasks, and how common they are
+STATUS_WEIGHTS = [
+    ('available', 40),
+    ('created', 5),
+    ('skipped', 8),
+    ('fixed', 25),
+    ('alreadyfixed', 7),
+    ('falsepositive', 6),
+    ('deleted', 3),
+    ('assigned', 3),
+    ('editing', 3)]
+
+EDITOR_WEIGHTS = [
+    ('josm', 4),
+    ('id', 6)]
+
+# the area the challenges without a bounding box are spread over
+WORLD_BOUNDS = (-120, 20, -40, 50)
+
+task_instruction_text = "Task instruction text"
+
+# the time the action history runs up to by default, fixed so that the
+# same seed gives the same data on every run
+DEFAULT_END = datetime(2017, 1, 1)
+
+
+class WeightedChoice(object):
+
+    """Picks values at random, in proportion to their weights"""
+
+    def __init__(self, rng, weights):
+        self.rng = rng
+        self.values = []
+        self.cumulative = []
+        total = 0
+        for value, weight in weights:
+            total += weight
+            self.values.append(value)
+            self.cumulative.append(total)
+        self.total = total
+
+    def __call__(self):
+        return self.values[
+            bisect(self.cumulative, self.rng.random() * self.total)]
+
+
+def point_ewkt(x, y, srid=None):
+    wkt = 'POINT(%.7f %.7f)' % (x, y)
+    return 'SRID=%i;%s' % (srid, wkt) if srid else wkt
+
+
+def linestring_ewkt(coordinates):
+    return 'LINESTRING(%s)' % ', '.join(
+        '%.7f %.7f' % (x, y) for x, y in coordinates)
+
+
+class TestDataGenerator(object):
+
+    """Writes challenges, tasks, task geometries, users and actions
+    straight to the database with COPY.
+
+    Everything is drawn from a random generator seeded with 'seed', so
+    the same arguments give the same data. Tasks are clustered around
+    a few centers per challenge, have a mix of final statuses, and an
+    action history leading up to that status spread over the 'days'
+    days before 'end' (a naive UTC datetime, defaulting to DEFAULT_END).
+    The leases of the assigned and editing tasks run until shortly
+    after 'end'. A few users do most of the work."""
+
+    def __init__(self, challenges=10, tasks=100, users=10, seed=0,
+                 days=365, clusters=5, end=None):
+        self.challenges = challenges
+        self.tasks = tasks
+        self.users = users
+        self.days = days
+        self.clusters = clusters
+        self.rng = random.Random(seed)
+        self.status = WeightedChoice(self.rng, STATUS_WEIGHTS)
+        self.editor = WeightedChoice(self.rng, EDITOR_WEIGHTS)
+        self.user = WeightedChoice(
+            self.rng, [(uid, 1.0 / (uid + 1)) for uid in range(users)])
+        self.end = end if end is not None else DEFAULT_END
+        self.lease = timedelta(
+            seconds=app.config.get('TASK_LEASE_SECONDS', 3600))
+        self.task_id = 0
+        self.counts = {'tasks': 0, 'geometries': 0, 'actions': 0}
+
+    def run(self):
+        self.clear()
+        self.create_users()
+        for i in range(1, self.challenges + 1):
+            challenge, bounds = self.create_challenge(i)
+            print("\tGenerating %i tasks for challenge %s" % (
+                self.tasks, challenge.slug))
+            self.create_tasks(challenge, bounds)
+        self.finish()
+        return self.counts
+
+    def copy(self, table, columns, f):
+        f.seek(0)
+        cursor = db.session.connection().connection.cursor()
+        cursor.copy_expert('COPY {table} ({columns}) FROM STDIN'.format(
+            table=table, columns=', '.join(columns)), f)
+        f.close()
+
+    def spool(self):
+        return tempfile.SpooledTemporaryFile(
+            max_size=app.config.get('BULK_LOAD_SPOOL_SIZE', 16 * 1024 * 1024))
+
+    def clear(self):
+        """Delete the old test data"""
+        # the metrics go too, as the action ids start over
+        db.session.execute(
+            'TRUNCATE task_geometries, actions, tasks, challenges, users, '
+            'challenge_status_counts, challenge_tile_counts, metrics_state, '
+            'metrics_historical, metrics_aggregate, metrics_rollups, '
+            'leaderboard_scores, metrics_queue RESTART IDENTITY CASCADE')
+        db.session.commit()
+
+    def create_users(self):
+        f = self.spool()
+        for uid in range(self.users):
+            f.write(copy_row([uid, 'Test User {uid}'.format(uid=uid)]))
+        self.copy('users', ['id', 'display_name'], f)
+        db.session.commit()
+
+    def create_challenge(self, i):
+        rng = self.rng
+        slug = "test%d" % i
+        print("Generating Test Challenge %s" % slug)
+        challenge = Challenge(slug, "Test Challenge %d" % i)
+        challenge.difficulty = rng.choice([1, 2, 3])
+        challenge.active = True
+        challenge.blurb = "This is test challenge number %d" % i
+        challenge.description = "This describes challenge %d in detail" % i
+        challenge.help = "Sample challenge *help* text"
+        challenge.instruction = "Challenge instruction text"
+        # have bounding boxes for all but the first two challenges.
+        bounds = WORLD_BOUNDS
+        if i > 2:
+            minx = rng.randrange(-120, -40)
+            miny = rng.randrange(20, 50)
+            bounds = (minx, miny, minx + 1, miny + 1)
+            challenge.polygon = box(*bounds)
+        db.session.add(challenge)
+        db.session.commit()
+        return challenge, bounds
+
+    def location(self, bounds, centers, spread):
+        """Return a point near one of the cluster centers, or
+        (one time in ten) anywhere within the bounds"""
+        rng = self.rng
+        minx, miny, maxx, maxy = bounds
+        if rng.random() < 0.1:
+            return rng.uniform(minx, maxx), rng.uniform(miny, maxy)
+        x, y = rng.choice(centers)
+        return (min(max(rng.gauss(x, spread), minx), maxx),
+                min(max(rng.gauss(y, spread), miny), maxy))
+
+    def history(self, status):
+        """Return the (timestamp, user, status, editor) actions that lead
+        a task up to 'status', and the end of its lease if it is leased"""
+        rng = self.rng
+        span = timedelta(days=self.days).total_seconds() / 2
+        if status in LEASED_STATUSES:
+            # a lease that is still running at the end
+            end = self.end - timedelta(seconds=rng.random() * 600)
+        else:
+            end = self.end - timedelta(seconds=rng.random() * span)
+        t = end - timedelta(seconds=rng.random() * span)
+        actions = [(t, None, 'created', None)]
+        steps = []
+        if status == 'available':
+            steps.append((None, 'available', None))
+        elif status == 'deleted':
+            steps.append((None, 'deleted', None))
+        elif status != 'created':
+            # a few mappers had a look and skipped the task first
+            skips = int(rng.expovariate(1.0))
+            if status == 'skipped':
+                skips += 1
+            for n in range(skips):
+                user = self.user()
+                steps.extend([(user, 'assigned', None), (user, 'skipped', None)])
+            if status != 'skipped':
+                user = self.user()
+                steps.append((user, 'assigned', None))
+                if status != 'assigned':
+                    editor = self.editor()
+                    steps.append((user, 'editing', editor))
+                    if status != 'editing':
+                        steps.append((user, status, editor))
+        # spread the steps over the time between creation and the end
+        gap = (end - t) // (len(steps) or 1)
+        for user, step, editor in steps:
+            t += gap
+            actions.append((t, user, step, editor))
+        assigned_until = t + self.lease if status in LEASED_STATUSES else None
+        return actions, assigned_until
+
+    def create_tasks(self, challenge, bounds):
+        rng = self.rng
+        minx, miny, maxx, maxy = bounds
+        centers = [(rng.uniform(minx, maxx), rng.uniform(miny, maxy))
+                   for c in range(self.clusters)]
+        spread = (maxx - minx) / 20.0
+        tasks, geometries, actions = self.spool(), self.spool(), self.spool()
+        for j in range(self.tasks):
+            self.task_id += 1
+            x, y = self.location(bounds, centers, spread)
+            status = self.status()
+            history, assigned_until = self.history(status)
+            # the first point and, for every other task, a line from it
+            # to a point close by. The location of the task is the point,
+            # as that is the coordinate closest to the centroid of all of
+            # the task's coordinates (see Task.set_location).
+            geometries.write(copy_row([
+                self.task_id, rng.randint(1, 5000000000), point_ewkt(x, y)]))
+            if not j % 2:
+                x2 = x + rng.random() * rng.choice((1, -1)) * 0.01
+                y2 = y + rng.random() * rng.choice((1, -1)) * 0.01
+                geometries.write(copy_row([
+                    self.task_id, rng.randint(1, 5000000000),
+                    linestring_ewkt([(x, y), (x2, y2)])]))
+                self.counts['geometries'] += 1
+            self.counts['geometries'] += 1
+            tasks.write(copy_row([
+                self.task_id,
+                '%032x' % rng.getrandbits(128),
+                challenge.slug,
+                rng.random(),
+                point_ewkt(x, y, srid=4326),
+                status,
+                task_instruction_text,
+                assigned_until]))
+            for timestamp, user, action_status, editor in history:
+                actions.write(copy_row([
+                    timestamp, user, self.task_id, action_status, editor]))
+            self.counts['actions'] += len(history)
+        self.copy('tasks', [
+            'id', 'identifier', 'challenge_slug', 'random', 'location',
+            'status', 'instruction', 'assigned_until'], tasks)
+        self.copy('task_geometries', ['task_id', 'osmid', 'geom'], geometries)
+        self.copy('actions', [
+            'timestamp', 'user_id', 'task_id', 'status', 'editor'], actions)
+        db.session.commit()
+        self.counts['tasks'] += self.tasks
+
+    def finish(self):
+        # the task ids were set here, so move the sequence past them
+        db.session.execute(
+            "SELECT setval('tasks_id_seq', GREATEST(max(id), 1)) FROM tasks")
+        db.session.execute(
+            "SELECT setval(pg_get_serial_sequence('users', 'id'), "
+            "GREATEST(max(id), 1)) FROM users")
+        db.session.execute('ANALYZE')
+        db.session.commit()
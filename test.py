@@ -24,5 +24,130 @@ class MaprouletteTestCase(unittest.TestCase):
         assert return_value.data[:2] == "[]"
 
 
+
+class TaskLoaderTestCase(unittest.TestCase):
+
+    def setUp(self):
+        maproulette.app.config['SQLALCHEMY_DATABASE_URI'] = 'postgresql://martijnv@localhost/maproulette_test'
+        maproulette.app.config['TESTING'] = True
+        from maproulette import db
+        from maproulette.models import Challenge
+        db.create_all()
+        db.session.add(Challenge('loadertest', 'Loader test'))
+        db.session.commit()
+
+    def tearDown(self):
+        from maproulette import db
+        db.session.execute("DELETE FROM challenges WHERE slug = 'loadertest'")
+        db.session.commit()
+
+    def test_load_creates_tasks(self):
+        '''assert that the loader creates tasks with ids, geometries
+        and a first action'''
+        from shapely.geometry import Point
+        from maproulette.bulkload import TaskLoader
+        from maproulette.models import Task
+        loader = TaskLoader('loadertest')
+        loader.add('one', [(Point(1, 2), 5)], instruction='do this')
+        loader.add('two', instruction='do that')
+        result = loader.load()
+        assert result['created'] == 2
+        tasks = Task.query.filter_by(
+            challenge_slug='loadertest').order_by(Task.identifier).all()
+        assert [t.identifier for t in tasks] == ['one', 'two']
+        assert tasks[0].id is not None and tasks[1].id is not None
+        assert tasks[0].id != tasks[1].id
+        assert [g.osmid for g in tasks[0].geometries] == [5]
+        assert [a.status for a in tasks[0].actions] == ['created']
+
+    def test_load_fractional_property(self):
+        '''assert that a streamed task with fractional numbers outside
+        its coordinates loads'''
+        from StringIO import StringIO
+        from maproulette.bulkload import TaskLoader
+        from maproulette.helpers import json_tasks
+        loader = TaskLoader('loadertest')
+        loader.add_json_many(json_tasks(StringIO(FRACTIONAL_TASKS)))
+        assert loader.load()['created'] == 1
+
+
+# a task whose feature has a fractional property and a bounding box
+FRACTIONAL_TASKS = '''[{"identifier": "three", "instruction": "do this",
+    "geometries": {"type": "FeatureCollection", "features": [{
+        "type": "Feature", "bbox": [1.5, 2.5, 1.5, 2.5],
+        "properties": {"osmid": 7, "score": 0.75},
+        "geometry": {"type": "Point", "coordinates": [1.5, 2.5]}}]}}]'''
+
+
+class JsonTasksTestCase(unittest.TestCase):
+
+    def test_prepare_fractional_property(self):
+        '''assert that streamed tasks are hashed with their fractional
+        numbers as floats'''
+        import json
+        from StringIO import StringIO
+        from maproulette.bulkload import prepare_task, task_content_hash
+        from maproulette.helpers import json_tasks
+        tasks = list(json_tasks(StringIO(FRACTIONAL_TASKS)))
+        properties = tasks[0]['geometries']['features'][0]['properties']
+        assert properties == {'osmid': 7, 'score': 0.75}
+        prepared = prepare_task(tasks[0])
+        assert prepared[0] == 'three'
+        assert prepared[-1] == task_content_hash(
+            json.loads(FRACTIONAL_TASKS)[0])
+
+
+class SchemaTestCase(unittest.TestCase):
+
+    def test_create_all(self):
+        '''assert that the schema, with the triggers created along
+        with the tables, compiles for PostgreSQL'''
+        from maproulette import db
+        statements = []
+
+        def executor(sql, *multiparams, **params):
+            if not isinstance(sql, basestring):
+                sql = unicode(sql.compile(dialect=engine.dialect))
+            statements.append(sql)
+
+        engine = create_engine(
+            'postgresql://', strategy='mock', executor=executor)
+        db.metadata.create_all(engine, checkfirst=False)
+        triggers = [sql for sql in statements if 'CREATE TRIGGER' in sql]
+        assert len(triggers) == 2
+        assert 'pg_backend_pid()' in triggers[0] + triggers[1]
+
+
+class StatsDictTestCase(unittest.TestCase):
+
+    def test_as_stats_dict(self):
+        '''assert that stats are grouped, and padded with every day'''
+        from datetime import datetime
+        from maproulette.helpers import as_stats_dict
+        result = as_stats_dict([
+            ('fixed', datetime(2014, 1, 1), 2),
+            ('skipped', datetime(2014, 1, 3), 1)],
+            end=datetime(2014, 1, 4))
+        assert result == [
+            {'key': 'fixed', 'values': {
+                '2014-01-01T00:00:00': 2,
+                '2014-01-02T00:00:00': 0,
+                '2014-01-03T00:00:00': 0}},
+            {'key': 'skipped', 'values': {
+                '2014-01-01T00:00:00': 0,
+                '2014-01-02T00:00:00': 0,
+                '2014-01-03T00:00:00': 1}}]
+
+    def test_as_stats_dict_breakdown(self):
+        '''assert that stats without dates are grouped as they are'''
+        from maproulette.helpers import as_stats_dict
+        assert as_stats_dict([]) == {}
+        assert as_stats_dict([
+            ('bob', 'fixed', 2),
+            ('alice', 'fixed', 1),
+            ('bob', 'skipped', 3)]) == [
+            {'key': 'alice', 'values': {'fixed': 1}},
+            {'key': 'bob', 'values': {'fixed': 2, 'skipped': 3}}]
+
 if __name__ == '__main__':
     unittest.main()
\ No newline at end of file